@@ -0,0 +1,133 @@
+import os
+
+
+def parse_cpus(spec):
+    """Sorted CPUs of a list like '0-7,16-23'."""
+    cpus = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            low, high = part.split('-')
+            cpus.update(range(int(low), int(high) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def format_cpus(cpus):
+    """Inverse of `parse_cpus`."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(
+        str(low) if low == high else '{}-{}'.format(low, high)
+        for low, high in ranges)
+
+
+def check_cpus(cpus, option):
+    """Fail unless this process may run on every one of `cpus`."""
+    if not cpus:
+        raise Exception('{} lists no cpus!'.format(option))
+    if not hasattr(os, 'sched_getaffinity'):
+        return
+    allowed = os.sched_getaffinity(0)
+    outside = sorted(set(cpus) - allowed)
+    if outside:
+        raise Exception('{} has cpus {} outside the usable {}!'.format(
+            option, format_cpus(outside), format_cpus(allowed)))
+
+
+def split_cpus(cpus, n):
+    """`n` core sets out of `cpus`, disjoint when there are enough cores."""
+    if len(cpus) < n:
+        return [[cpus[i % len(cpus)]] for i in range(n)]
+    bounds = [len(cpus) * i // n for i in range(n + 1)]
+    return [cpus[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+def pin(cpus, pid=0):
+    """Restrict process `pid`, this one by default, to `cpus`.
+
+    Threads inherit the mask of the thread creating them, so pin before
+    starting any.
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(pid, cpus)
+
+
+def pin_threads(cpus):
+    """Restrict every thread of this process to `cpus`, started or not."""
+    tasks = '/proc/self/task'
+    if not os.path.isdir(tasks):
+        return pin(cpus)
+    for tid in os.listdir(tasks):
+        pin(cpus, int(tid))
+
+
+def cpu_nodes(root='/sys/devices/system/node'):
+    """NUMA node of every CPU, empty where sysfs does not tell."""
+    nodes = {}
+    if not os.path.isdir(root):
+        return nodes
+    for name in os.listdir(root):
+        if not (name.startswith('node') and name[4:].isdigit()):
+            continue
+        with open(os.path.join(root, name, 'cpulist')) as f:
+            for cpu in parse_cpus(f.read()):
+                nodes[cpu] = int(name[4:])
+    return nodes
+
+
+def single_node(cpus):
+    """The NUMA node holding all of `cpus`, None if unknown or several."""
+    if cpus is None:
+        return None
+    nodes = cpu_nodes()
+    on = set(nodes.get(c) for c in cpus)
+    if len(on) != 1 or None in on:
+        return None
+    return on.pop()
+
+
+def layout(learner_cpus, worker_sets, tf_threads=(0, 0)):
+    """Lines describing where the learner, TF and subagents run."""
+    nodes = cpu_nodes()
+
+    def where(cpus):
+        if cpus is None:
+            return 'any cpu'
+        on = sorted(set(nodes[c] for c in cpus if c in nodes))
+        text = 'cpus {}'.format(format_cpus(cpus))
+        if on:
+            text += ' (node {})'.format(','.join(str(n) for n in on))
+        return text
+
+    intra, inter = tf_threads
+    lines = [
+        'learner and TF threads: {}, intra op {}, inter op {}'.format(
+            where(learner_cpus), intra or 'auto', inter or 'auto')
+    ]
+    if worker_sets is None:
+        lines.append('subagents: any cpu')
+    else:
+        cores = sorted(set(len(s) for s in worker_sets))
+        each = str(cores[0])
+        if len(cores) > 1:
+            each = '{}-{}'.format(cores[0], cores[-1])
+        lines.append('subagents: {} processes on {}, {} cores each'.format(
+            len(worker_sets), where(sorted(set(sum(worker_sets, [])))),
+            each))
+    node = single_node(learner_cpus)
+    if node is not None:
+        lines.append(
+            'replay memory: node {}, faulted in by the learner'.format(node))
+    elif not nodes:
+        lines.append('replay memory: NUMA topology unknown')
+    else:
+        lines.append('replay memory: wherever first touched')
+    return lines
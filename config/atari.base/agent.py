@@ -1,74 +1,765 @@
 import os
 import zmq
+import time
+import signal
+import select
 import msgpack
+import subprocess
 import numpy as np
 import msgpack_numpy
-from collections import OrderedDict
+from collections import deque
+from affinity import split_cpus
+from replay_server import insert_url
+from protocol import (pack_indices, pack_step, pack_timing, unpack_states,
+                      unpack_step, unpack_timing)
 
 msgpack_numpy.patch()
 
 
+def connect_url(url):
+    """The address local workers connect to for a bound `url`."""
+    for host in ('*', '0.0.0.0'):
+        url = url.replace('tcp://{}:'.format(host), 'tcp://127.0.0.1:')
+    return url
+
+
+def absolute_url(url):
+    """`url` with an ipc:// path valid from any working directory."""
+    if url.startswith('ipc://'):
+        return 'ipc://' + os.path.abspath(url[len('ipc://'):])
+    return url
+
+
 class Agent(object):
-    """Control agents' threads."""
+    """Control agents' threads.
+
+    Every subagent process hosts `envs_per_worker` consecutive agents and
+    answers each request with one batched message. Slices of workers can be
+    stepped asynchronously with `step_async` and `step_wait`, and
+    `step_ready` steps whichever workers are idle and returns as soon as
+    enough of them replied.
+
+    Workers are forked from one template process, see
+    `subagent.serve_template`. A worker found dead while replies are
+    awaited is respawned and resynced: its environments are reset and an
+    unanswered step is answered as a terminal one. A worker dying
+    `max_respawns` times within `respawn_window` seconds is an error.
+
+    The Agent binds `url`, ipc:// under .ipc/<basename> by default. With a
+    tcp:// url only the first `local_workers` workers are started here, the
+    others are `subagent.py --url ... --identity i` processes on other
+    hosts. Those cannot share memory with the learner, nor are they
+    respawned. They must be started with the learner's --uint8_obs,
+    --num_envs (its `envs_per_worker`) and --single_frame (its
+    `stack_on_learner`), which is checked when they connect.
+
+    With a `pool_url` the local workers are leased from a running
+    `worker_pool.py` instead, warm from earlier jobs, and handed back on
+    `close`.
 
-    def __init__(self, num_agents, game_name, basename):
+    Steps are traced, on the learner and in the subagents, see `stats` and
+    `throughput_table`.
+    """
+
+    def __init__(self,
+                 num_agents,
+                 game_name,
+                 basename,
+                 replay_url=None,
+                 shared_obs=False,
+                 uint8_obs=False,
+                 envs_per_worker=1,
+                 stack_on_learner=False,
+                 stack=4,
+                 health_interval=1.0,
+                 max_respawns=3,
+                 respawn_window=60.0,
+                 worker_cpus=None,
+                 url=None,
+                 local_workers=None,
+                 hot_spares=False,
+                 pool_url=None):
         self.game_name = game_name
         path = './.ipc/{}'.format(basename)
         if os.path.exists(path):
             os.system('rm {} -rf'.format(path))
         os.makedirs(path)
 
+        assert num_agents % envs_per_worker == 0
         self.num_agents = num_agents
-        command = 'python3 subagent.py --game_name {} --basename {}'.format(
-            game_name, basename)
-        for i in range(num_agents):
-            os.system(command + ' --identity {} &'.format(i))
-
-        url = 'ipc://./.ipc/{}/Agent.ipc'.format(basename)
+        self.envs_per_worker = envs_per_worker
+        self.num_workers = num_agents // envs_per_worker
+        if url is None:
+            url = 'ipc://./.ipc/{}/Agent.ipc'.format(basename)
+        if local_workers is None:
+            local_workers = self.num_workers
+        self.local_workers = local_workers
+        command = 'python3 subagent.py --game_name {} --url {}'.format(
+            game_name, connect_url(url))
+        if replay_url is not None:
+            # subagents insert their transitions into a replay server
+            command += ' --replay_url {}'.format(replay_url)
+        if uint8_obs:
+            # observations stay raw pixels, estimators scale them
+            command += ' --uint8_obs'
+        self.obs_dtype = np.uint8 if uint8_obs else np.float32
+        command += ' --num_envs {}'.format(envs_per_worker)
+        if stack_on_learner:
+            # only the newest frame travels, stacks are rebuilt here
+            command += ' --single_frame'
+        self.single_frame = stack_on_learner
+        if hot_spares:
+            # game overs swap in an env reset ahead of time
+            command += ' --hot_spares'
         self.context = zmq.Context()
+        self.template = None
+        self.pool = None
+        # waitpid status of exited workers by pid, as the template reports
+        self.exits = {}
+        if pool_url is None:
+            # workers are forked from a template with the modules imported
+            self.template = subprocess.Popen(
+                (command + ' --template').split(),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                bufsize=0)
+            # unread template output
+            self.template_out = b''
+        else:
+            self.pool = self.context.socket(zmq.REQ)
+            self.pool.connect(pool_url)
+            self.worker_key = (game_name, uint8_obs, envs_per_worker,
+                               stack_on_learner, hot_spares)
+            # the pool's workers run in its working directory
+            self.lease_url = absolute_url(connect_url(url))
+            self.lease_replay_url = None
+            if replay_url is not None:
+                self.lease_replay_url = absolute_url(replay_url)
+        # seconds between liveness checks while waiting for replies
+        self.health_interval = health_interval
+        # recent respawn times, by worker
+        self.respawns = {}
+        self.max_respawns = max_respawns
+        self.respawn_window = respawn_window
+        # cores each worker is pinned to
+        self.worker_cpus = None
+        if worker_cpus is not None:
+            self.worker_cpus = split_cpus(worker_cpus, local_workers)
+        # remote workers have no pid here
+        self.pids = [self._spawn(i) for i in range(local_workers)]
+        self.pids += [None] * (self.num_workers - local_workers)
+
         self.agent_socket = self.context.socket(zmq.ROUTER)
+        # a respawned worker takes over the identity of the dead one
+        self.agent_socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
         self.agent_socket.bind(url)
+        # episode statistics pushed by the workers
+        self.episode_socket = self.context.socket(zmq.PULL)
+        self.episode_socket.bind(insert_url(url))
+        # episode statistics not returned yet, by agent
+        self.episodes = {}
 
-        self.addrs = OrderedDict()
+        self.addrs = [
+            'SubAgent-{}'.format(i).encode('utf-8')
+            for i in range(self.num_workers)
+        ]
+        self.workers = {addr: i for i, addr in enumerate(self.addrs)}
+        # replies not waited for yet, by worker
+        self.replies = {}
+        # requests not replied to yet, by worker
+        self.requests = {}
+        # when requests were sent and replies arrived, by worker
+        self.sent = {}
+        self.arrived = {}
+        # last time dead workers were looked for
+        self.checked = time.time()
+        # recent learner side timings, reported and cleared by `stats`
+        self._trace = {
+            name: deque(maxlen=1000)
+            for name in ('send', 'wait', 'decode')
+        }
+        # recent (worker, roundtrip) + protocol.TIMING rows
+        self._worker_trace = deque(maxlen=10000)
+        self._worker_steps = np.zeros(self.num_workers, dtype=np.int64)
+        self._traced_since = time.time()
+        self._worker_rows = []
+        self.memory = None
+        self.obs = None
         self.action_n, self.state_shape = self._prepare()
+        # newest stack of every agent when frames are stacked here
+        self.stacks = None
+        if stack_on_learner:
+            self.stacks = np.zeros(
+                (num_agents, ) + tuple(self.state_shape[:2]) + (stack, ),
+                dtype=self.obs_dtype)
+        # workers stepping, with their actions and replay rows
+        self.pending = {}
+        if shared_obs:
+            self._share_obs(basename)
+
+    def _spawn(self, i):
+        if self.pool is not None:
+            cpus = None
+            if self.worker_cpus is not None:
+                cpus = self.worker_cpus[i]
+            self.pool.send(
+                msgpack.dumps((b'lease', self.worker_key, self.lease_url,
+                               str(i), self.lease_replay_url, cpus)))
+            return msgpack.loads(self.pool.recv())
+        line = str(i)
+        if self.worker_cpus is not None:
+            line += ' ' + ','.join(str(c) for c in self.worker_cpus[i])
+        self.template.stdin.write((line + '\n').encode('utf-8'))
+        while True:
+            pid = self._template_line()
+            if pid is not None:
+                return pid
+
+    def _template_line(self, timeout=None):
+        """Pid in the next line of the template, None for an exit.
+
+        Also None if nothing came within `timeout`.
+        """
+        fd = self.template.stdout.fileno()
+        while b'\n' not in self.template_out:
+            if not select.select([fd], [], [], timeout)[0]:
+                return None
+            data = os.read(fd, 4096)
+            if not data:
+                raise Exception('the subagent template exited!')
+            self.template_out += data
+        line, self.template_out = self.template_out.split(b'\n', 1)
+        fields = line.split()
+        if fields[0] == b'exit':
+            self.exits[int(fields[1])] = int(fields[2])
+            return None
+        return int(fields[0])
+
+    def _exit_status(self, pid, timeout=1.0):
+        """How worker `pid` exited, as the template reports it."""
+        if self.template is not None:
+            deadline = time.time() + timeout
+            while pid not in self.exits and time.time() < deadline:
+                self._template_line(max(deadline - time.time(), 0))
+        if pid not in self.exits:
+            return 'unknown exit status'
+        status = self.exits[pid]
+        if os.WIFSIGNALED(status):
+            return 'killed by signal {}'.format(os.WTERMSIG(status))
+        return 'exit code {}'.format(os.WEXITSTATUS(status))
+
+    def _count_respawn(self, i):
+        """Note a respawn of worker `i`, raising if it keeps dying."""
+        now = time.time()
+        times = self.respawns.setdefault(i, deque(maxlen=self.max_respawns))
+        if len(times) == times.maxlen and now - times[0] < self.respawn_window:
+            status = self._exit_status(self.pids[i])
+            raise Exception('subagent {} died {} times within {:.0f} s, '
+                            'last with {}'.format(i,
+                                                  len(times) + 1,
+                                                  now - times[0], status))
+        times.append(now)
+
+    def _alive(self, i):
+        if self.pids[i] is None:
+            return True
+        try:
+            os.kill(self.pids[i], 0)
+        except OSError:
+            return False
+        return True
 
     def _prepare(self):
-        for _ in range(self.num_agents):
-            addr, empty, msg = self.agent_socket.recv_multipart()
-            msg = msgpack.loads(msg)
-            self.addrs[addr] = None
-            # print(msg)
+        workers = range(self.num_workers)
+        # every worker says it is ready once started
+        self.requests = {i: None for i in workers}
+        if self.local_workers < self.num_workers:
+            print('waiting for subagents {} to {} to connect'.format(
+                self.local_workers, self.num_workers - 1))
+        expected = (np.dtype(self.obs_dtype), self.envs_per_worker,
+                    self.single_frame)
+        for i, parts in zip(workers, self._recv(workers)):
+            msg = msgpack.loads(parts[0].bytes)
             assert msg[0] == b'ready'
             action_n = msg[1]
             state_shape = msg[2]
+            # dtype, envs and whether frames are stacked on the learner
+            flags = (np.dtype(msg[3]), msg[4], state_shape[-1] == 1)
+            assert flags == expected, (
+                'subagent {} sends {} observations of {} envs, single frame '
+                '{}, the learner expects {}, {}, {}'.format(
+                    i, *(flags + expected)))
         return action_n, state_shape
 
+    def groups(self, num_groups):
+        """Split the agents into `num_groups` slices of whole workers."""
+        assert num_groups <= self.num_workers
+        n = self.envs_per_worker
+        bounds = np.linspace(0, self.num_workers, num_groups + 1).astype(int)
+        return [slice(a * n, b * n) for a, b in zip(bounds, bounds[1:])]
+
+    def _slice_workers(self, agents):
+        """Workers hosting the `agents` slice."""
+        start, stop, _ = agents.indices(self.num_agents)
+        n = self.envs_per_worker
+        assert start % n == 0 and stop % n == 0
+        return list(range(start // n, stop // n))
+
+    def _agents(self, workers):
+        n = self.envs_per_worker
+        return (np.asarray(workers)[:, None] * n + np.arange(n)).reshape(-1)
+
+    def _split(self, x):
+        """Per worker slices of a batch over their agents."""
+        n = self.envs_per_worker
+        return [x[i:i + n] for i in range(0, len(x), n)]
+
+    def _send(self, workers, msgs):
+        """Send each worker its multipart request."""
+        for i, msg in zip(workers, msgs):
+            self.requests[i] = msg
+            self.agent_socket.send_multipart([self.addrs[i], b''] + msg)
+
+    def _poll(self, timeout=None, check=True):
+        """Keep the next reply, False if none came within `timeout`.
+
+        With `check`, dead workers are respawned every `health_interval`,
+        whether replies keep coming or not.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if check and time.time() - self.checked >= self.health_interval:
+                self.checked = time.time()
+                if self._check_workers():
+                    # the respawned workers' replies are kept
+                    return True
+            wait = self.health_interval
+            if deadline is not None:
+                wait = min(wait, max(deadline - time.time(), 0))
+            if self.agent_socket.poll(wait * 1000):
+                break
+            if deadline is not None and time.time() >= deadline:
+                return False
+        # frames are kept as zmq buffers, states are views of them
+        parts = self.agent_socket.recv_multipart(copy=False)
+        i = self.workers[parts[0].bytes]
+        self.arrived[i] = time.time()
+        self.requests.pop(i, None)
+        self.replies[i] = parts[2:]
+        return True
+
+    def _recv(self, workers):
+        """Wait for the replies of `workers`, keeping others for later."""
+        while not all(i in self.replies for i in workers):
+            self._poll()
+        return [self.replies.pop(i) for i in workers]
+
+    def _check_workers(self):
+        """Respawn dead workers owing a reply, True if there were any."""
+        dead = [i for i in self.requests if not self._alive(i)]
+        for i in dead:
+            print('subagent {} died, respawning'.format(i))
+            self._respawn(i)
+        return len(dead) > 0
+
+    def _wait(self, i):
+        """Reply of worker `i`, None if it died first."""
+        while i not in self.replies:
+            # while respawning, other workers are checked once done
+            if (not self._poll(self.health_interval, check=False)
+                    and not self._alive(i)):
+                self.requests.pop(i, None)
+                return None
+        return self.replies.pop(i)
+
+    def _call(self, i, msg):
+        self._send([i], [msg])
+        return self._wait(i)
+
+    def _respawn(self, i):
+        """Restart worker `i` and answer its unanswered request."""
+        request = self.requests.pop(i)
+        while True:
+            self._count_respawn(i)
+            self.pids[i] = self._spawn(i)
+            ready = self._wait(i)
+            if ready is None:
+                continue
+            if request is None:
+                # still preparing, the ready message is the awaited reply
+                self.replies[i] = ready
+                return
+            reply = self._resync(i, request)
+            if reply is not None:
+                break
+        if reply is not True:
+            self.replies[i] = reply
+
+    def _resync(self, i, request):
+        """Bring a fresh worker `i` back to where the learner is.
+
+        Returns the reply to `request`, True once it is resent instead, or
+        None if the worker died again.
+        """
+        if self.memory is not None:
+            if self._call(i, self._attach_msg(i)) is None:
+                return None
+        if self.obs is not None:
+            if self._call(i, self._observe_msg(i)) is None:
+                return None
+        kind = request[0]
+        if i not in self.pending:
+            if kind in (b'reset', b'close'):
+                self._send([i], [request])
+                return True
+            # attach and observe were just replayed
+            reply = {b'attach': b'attached', b'observe': b'observed'}[kind]
+            return [zmq.Frame(reply)]
+        # the step is lost, its episode ends and the envs are reset
+        rows = self.pending[i][1]
+        msg = [b'reset']
+        if rows is not None:
+            msg.append(pack_indices(rows))
+        states = self._call(i, msg)
+        if states is None:
+            return None
+        n = self.envs_per_worker
+        reply = [
+            zmq.Frame(pack_step(np.zeros(n), np.ones(n)).tobytes()),
+            zmq.Frame(pack_timing(0, 0, 0, 0).tobytes())
+        ]
+        if self.memory is None and self.obs is None:
+            return reply + states
+        return reply
+
+    def _attach_msg(self, i):
+        return [
+            b'attach',
+            msgpack.dumps((os.path.abspath(self.memory.path).encode('utf-8'),
+                           i * self.envs_per_worker, self.memory.size))
+        ]
+
+    def _observe_msg(self, i):
+        # a respawned worker writes next to the half the learner flips to
+        return [
+            b'observe',
+            msgpack.dumps((self.obs_path.encode('utf-8'),
+                           i * self.envs_per_worker, self.num_agents,
+                           self.halves[i * self.envs_per_worker]))
+        ]
+
+    def _states(self, frame):
+        return unpack_states(frame.buffer, self.obs_dtype, self.state_shape)
+
+    def _episodes(self, agents):
+        """Statistics of the episodes `agents` finished, by agent.
+
+        They arrive apart from the step replies, a few steps late at most.
+        """
+        while True:
+            try:
+                msg = self.episode_socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            agent, episode = msgpack.loads(msg)
+            self.episodes[agent] = episode
+        return {
+            int(agent): self.episodes.pop(agent)
+            for agent in agents if agent in self.episodes
+        }
+
+    def _local(self):
+        assert self.local_workers == self.num_workers, (
+            'remote subagents cannot share memory with the learner')
+
+    def _share_obs(self, basename):
+        """Let subagents write observations into a shared batch array.
+
+        `reset` and `step` then return a view of that array instead of a
+        copy, and only actions, rewards and dones travel over the socket.
+        """
+        self._local()
+        self.obs_path = os.path.join('/dev/shm', '{}.obs'.format(basename))
+        # two halves, so the states of a step survive the next step
+        self.obs = np.memmap(
+            self.obs_path,
+            dtype=self.obs_dtype,
+            mode='w+',
+            shape=(2, self.num_agents) + tuple(self.state_shape))
+        # the half each agent wrote last
+        self.halves = np.zeros(self.num_agents, dtype=np.int64)
+        workers = range(self.num_workers)
+        self._send(workers, [self._observe_msg(i) for i in workers])
+        for parts in self._recv(workers):
+            assert parts[0].bytes == b'observed'
+
+    def _obs_states(self, agents):
+        half = self.halves[agents]
+        if np.all(half == half[0]) and np.all(np.diff(agents) == 1):
+            return self.obs[half[0], agents[0]:agents[-1] + 1]
+        return self.obs[half, agents]
+
+    def attach(self, memory):
+        """Let subagents write frames straight into `memory`'s shared files.
+
+        `reset` and `step` then record every transition in `memory` and only
+        rewards, dones and row indices travel over the socket.
+        """
+        assert memory.path is not None
+        self._local()
+        # set first, so a respawned worker is attached as well
+        self.memory = memory
+        workers = range(self.num_workers)
+        self._send(workers, [self._attach_msg(i) for i in workers])
+        for parts in self._recv(workers):
+            assert parts[0].bytes == b'attached'
+
     def reset(self):
-        for addr in self.addrs:
-            self.agent_socket.send_multipart([addr, b'', b'reset'])
-        for _ in range(self.num_agents):
-            addr, empty, msg = self.agent_socket.recv_multipart()
-            msg = msgpack.loads(msg)
-            self.addrs[addr] = msg
-        return np.array(list(self.addrs.values()))
+        assert not self.pending
+        workers = list(range(self.num_workers))
+        agents = np.arange(self.num_agents)
+        # episodes of the games before are not returned
+        self._episodes([])
+        self.episodes.clear()
+        if self.memory is not None:
+            rows = self.memory.reserve(agents)
+            self._send(workers, [[b'reset', pack_indices(x)]
+                                 for x in self._split(rows)])
+            self._recv(workers)
+            self.memory.commit_reset(agents, rows)
+            return self.memory.states(agents)
+        self._send(workers, [[b'reset']] * self.num_workers)
+        if self.obs is not None:
+            self._recv(workers)
+            # subagents flip halves in lockstep on every reset and step,
+            # once replied, as a worker respawned meanwhile starts from
+            # the half before
+            self.halves ^= 1
+            states = self._obs_states(agents)
+        else:
+            states = np.concatenate(
+                [self._states(parts[0]) for parts in self._recv(workers)])
+        return self._restack(agents, states,
+                             np.ones(self.num_agents, dtype=np.bool_))
+
+    def _restack(self, agents, states, resets):
+        """Push the newest frames of `states` onto the agents' stacks."""
+        if self.stacks is None:
+            return states
+        frames = states[..., -1:]
+        stacks = np.concatenate(
+            [self.stacks[agents][..., 1:], frames], axis=-1)
+        # a reset stack repeats its first frame, like FrameWarpAndStack
+        stacks[resets] = frames[resets]
+        self.stacks[agents] = stacks
+        return stacks
 
     def step(self, actions):
-        for action, addr in zip(actions, self.addrs.keys()):
-            self.agent_socket.send_multipart(
-                [addr, b'', msgpack.dumps(action)])
-
-        info = {}
-        for _ in range(self.num_agents):
-            addr, empty, msg = self.agent_socket.recv_multipart()
-            msg = msgpack.loads(msg)
-            if msg[-1]:
-                info[addr] = msg[-1]
-            self.addrs[addr] = msg[:-1]
-        states, rewards, dones = map(np.array, zip(*self.addrs.values()))
-        return states, rewards, dones, info
-
-    def close(self):
-        for addr in self.addrs:
-            self.agent_socket.send_multipart([addr, b'', b'close'])
-        self.agent_socket.close()
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions, agents=slice(None)):
+        """Send `actions` to the `agents` slice without waiting.
+
+        Each slice must be waited for with `step_wait` before it is stepped
+        again, slices of whole workers, see `groups`, step independently.
+        """
+        self._dispatch(self._slice_workers(agents), actions)
+
+    def step_wait(self, agents=slice(None)):
+        """Results of the last actions sent to the `agents` slice."""
+        workers = self._slice_workers(agents)
+        start = time.time()
+        replies = self._recv(workers)
+        self._trace['wait'].append(time.time() - start)
+        return self._complete(workers, replies)
+
+    def _idle(self):
+        return [i for i in range(self.num_workers) if i not in self.pending]
+
+    def ready_agents(self):
+        """Agents of the workers that are not stepping."""
+        return self._agents(self._idle())
+
+    def step_ready(self, actions, min_agents=None, timeout=None):
+        """Step `ready_agents()` and return the agents that replied first.
+
+        Returns once `min_agents` agents, all by default, have replied, or
+        after `timeout` seconds with whatever replied by then, at least one
+        worker. Agents that did not reply keep stepping and are returned by
+        a later call. Returns `(agents, states, rewards, dones, info)`.
+        """
+        self._dispatch(self._idle(), actions)
+        n = self.envs_per_worker
+        need = self.num_workers
+        if min_agents is not None:
+            need = min(need, -(-min_agents // n))
+        start = time.time()
+        deadline = None if timeout is None else start + timeout
+        while True:
+            workers = [i for i in self.pending if i in self.replies]
+            if len(workers) >= need:
+                break
+            left = None if deadline is None else deadline - time.time()
+            if workers and left is not None and left <= 0:
+                break
+            # block for the first reply, past the deadline if need be
+            self._poll(left if workers else None)
+        self._trace['wait'].append(time.time() - start)
+        workers.sort()
+        return [self._agents(workers)] + list(
+            self._complete(workers, self._recv(workers)))
+
+    def _dispatch(self, workers, actions):
+        actions = self._split(actions)
+        rows = [None] * len(workers)
+        msgs = [[b'step', pack_indices(a, np.int32)] for a in actions]
+        if self.memory is not None:
+            rows = self._split(self.memory.reserve(self._agents(workers)))
+            for msg, r in zip(msgs, rows):
+                msg.append(pack_indices(r))
+        for i, a, r in zip(workers, actions, rows):
+            assert i not in self.pending
+            self.pending[i] = (a, r)
+        start = time.time()
+        self._send(workers, msgs)
+        self._trace['send'].append(time.time() - start)
+        for i in workers:
+            self.sent[i] = start
+
+    def _complete(self, workers, replies):
+        start = time.time()
+        results = self._decode(workers, replies)
+        self._trace['decode'].append(time.time() - start)
+        for i, parts in zip(workers, replies):
+            # a respawned worker's reply never arrived
+            roundtrip = self.arrived.pop(i, start) - self.sent.pop(i)
+            self._worker_trace.append(
+                (i, roundtrip) + tuple(unpack_timing(parts[1].buffer)))
+            self._worker_steps[i] += 1
+        return results
+
+    def _decode(self, workers, replies):
+        agents = self._agents(workers)
+        actions, rows = zip(*[self.pending.pop(i) for i in workers])
+        rewards, dones = [
+            np.concatenate(x)
+            for x in zip(*[unpack_step(parts[0].buffer) for parts in replies])
+        ]
+        info = self._episodes(agents)
+        if self.memory is not None:
+            self.memory.commit(agents, np.concatenate(rows),
+                               np.concatenate(actions), rewards, dones)
+            return self.memory.states(agents), rewards, dones, info
+        if self.obs is not None:
+            self.halves[agents] ^= 1
+            states = self._obs_states(agents)
+        else:
+            states = np.concatenate(
+                [self._states(parts[2]) for parts in replies])
+        # the next state after done is a reset one
+        return self._restack(agents, states, dones), rewards, dones, info
+
+    def stats(self):
+        """Step latency percentiles since the last call, in ms.
+
+        `step_*` are the learner's send, wait and decode times per call,
+        `worker_*` per worker step: the roundtrip, the subagent's step with
+        the emulation and preprocessing summed over its envs, the
+        serialization of its reply and the transport, the rest of the
+        roundtrip. Also each worker's env steps per second.
+        """
+        s = {}
+        for name, times in self._trace.items():
+            if times:
+                times = np.array(times) * 1000
+                for q in (50, 90, 99):
+                    s['step_{}_ms_p{}'.format(name, q)] = np.percentile(
+                        times, q)
+                self._trace[name].clear()
+        now = time.time()
+        elapsed = now - self._traced_since
+        self._traced_since = now
+        steps = self._worker_steps * self.envs_per_worker / elapsed
+        self._worker_steps[:] = 0
+        if not self._worker_trace:
+            return s
+        trace = np.array(self._worker_trace)
+        self._worker_trace.clear()
+        workers = trace[:, 0].astype(np.int64)
+        names = ('roundtrip', 'step', 'emulate', 'preprocess', 'serialize')
+        columns = dict(zip(names, trace[:, 1:].T * 1000))
+        columns['transport'] = columns['roundtrip'] - columns['step']
+        for name, times in columns.items():
+            for q in (50, 90, 99):
+                s['worker_{}_ms_p{}'.format(name, q)] = np.percentile(times, q)
+        self._worker_rows = []
+        for i in np.unique(workers):
+            mine = workers == i
+            row = (i, steps[i], np.percentile(columns['roundtrip'][mine], 50),
+                   np.percentile(columns['roundtrip'][mine], 90),
+                   np.median(columns['step'][mine]),
+                   np.median(columns['emulate'][mine]))
+            s['worker_{}/steps_per_s'.format(i)] = row[1]
+            s['worker_{}/roundtrip_ms_p50'.format(i)] = row[2]
+            s['worker_{}/roundtrip_ms_p90'.format(i)] = row[3]
+            self._worker_rows.append(row)
+        return s
+
+    def throughput_table(self):
+        """Per worker table of the last `stats` call, stragglers flagged."""
+        if not self._worker_rows:
+            return ''
+        median = np.median([row[2] for row in self._worker_rows])
+        lines = ['worker  steps/s  rtt p50  rtt p90  step p50  emulate p50']
+        for row in self._worker_rows:
+            # a roundtrip well above the others' holds back whole steps
+            flag = '  slow' if row[2] > 1.5 * median else ''
+            lines.append('{:6d} {:8.1f} {:8.2f} {:8.2f} {:9.2f} {:12.2f}'
+                         .format(*row) + flag)
+        return '\n'.join(lines)
+
+    def _released(self, i):
+        parts = self.replies.get(i)
+        return parts is not None and parts[0].bytes == b'released'
+
+    def close(self, timeout=10):
+        """Close the workers, killing those still alive after `timeout`.
+
+        Leased workers are released to their pool instead, and killed if
+        they do not confirm within `timeout`. Steps still in flight are
+        waited for and their replies dropped.
+        """
+        deadline = time.time() + timeout
+        # a worker takes no request before it answered the one it is on
+        while time.time() < deadline and not all(
+                i in self.replies or not self._alive(i) for i in self.pending):
+            self._poll(0.05, check=False)
+        self.pending.clear()
+        self.replies.clear()
+        kind = b'close' if self.pool is None else b'release'
+        self._send(range(self.num_workers), [[kind]] * self.num_workers)
+        local = range(self.local_workers)
+        while time.time() < deadline:
+            if self.pool is None:
+                if not any(self._alive(i) for i in local):
+                    break
+                time.sleep(0.05)
+            elif all(self._released(i) or not self._alive(i) for i in local):
+                break
+            else:
+                self._poll(0.05, check=False)
+        for i in local:
+            if self._alive(i) and not self._released(i):
+                os.kill(self.pids[i], signal.SIGKILL)
+        if self.pool is None:
+            # the template exits once its stdin is closed
+            self.template.stdin.close()
+            self.template.wait()
+        else:
+            self.pool.close()
+        self.agent_socket.close(linger=0)
+        self.episode_socket.close(linger=0)
         self.context.term()
+        if self.obs is not None:
+            os.remove(self.obs_path)
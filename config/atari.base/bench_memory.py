@@ -0,0 +1,74 @@
+import time
+import click
+import numpy as np
+from memory import Memory
+
+
+def atari_frames(num_agents, rng):
+    """Pong-like 84x84 frames: flat background, two paddles and a ball."""
+    frames = np.full((num_agents, 84, 84), 87, dtype=np.uint8)
+    frames[:, :10] = 236
+    for i in range(num_agents):
+        left, right = rng.randint(10, 70, size=2)
+        bx, by = rng.randint(12, 80, size=2)
+        frames[i, left:left + 8, 8:10] = 147
+        frames[i, right:right + 8, 74:76] = 147
+        frames[i, by:by + 2, bx:bx + 2] = 236
+    return frames
+
+
+def fill(memory, num_agents, num_steps, rng):
+    frames = atari_frames(num_agents, rng)
+    states = np.repeat(frames[..., None], 4, axis=-1)
+    start = time.time()
+    for _ in range(num_steps):
+        frames = atari_frames(num_agents, rng)
+        next_states = np.concatenate([states[..., 1:], frames[..., None]], -1)
+        memory.extend((states, rng.randint(6, size=num_agents),
+                       np.zeros(num_agents), next_states,
+                       rng.uniform(size=num_agents) < 0.01))
+        states = next_states
+    return (time.time() - start) / num_steps
+
+
+def frame_bytes(memory):
+    if memory.compress:
+        return sum(len(f) for f in memory.frames.reshape(-1))
+    return memory.frames.nbytes
+
+
+@click.command()
+@click.option('--num_agents', type=int, default=32)
+@click.option('--num_steps', type=int, default=2000)
+@click.option('--batch_size', type=int, default=32)
+@click.option('--num_samples', type=int, default=500)
+@click.option('--cache_size', type=int, default=4096)
+def main(num_agents, num_steps, batch_size, num_samples, cache_size):
+    results = {}
+    for compress in (False, True):
+        rng = np.random.RandomState(0)
+        memory = Memory(
+            num_agents * num_steps,
+            num_agents,
+            compress=compress,
+            cache_size=cache_size)
+        extend_t = fill(memory, num_agents, num_steps, rng)
+
+        memory.sample(batch_size)
+        start = time.time()
+        for _ in range(num_samples):
+            memory.sample(batch_size)
+        sample_t = (time.time() - start) / num_samples
+
+        results[compress] = sample_t
+        print('compress={}: frames {:.1f} MB, extend {:.3f} ms/step, '
+              'sample {:.3f} ms/batch'.format(compress,
+                                              frame_bytes(memory) / 2**20,
+                                              extend_t * 1000,
+                                              sample_t * 1000))
+    print('compression adds {:.3f} ms per batch of {}.'.format(
+        (results[True] - results[False]) * 1000, batch_size))
+
+
+if __name__ == '__main__':
+    main()
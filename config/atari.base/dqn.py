@@ -1,8 +1,10 @@
 import os
 import time
 import pickle
+import shutil
 import numpy as np
-from memory import Memory
+from memory import Memory, PrioritizedMemory, Prefetcher
+from replay_server import RemoteMemory
 from collections import defaultdict
 from tensorboardX import SummaryWriter
 
@@ -48,9 +50,23 @@ def dqn(env,
         update_target_every=1000,
         learning_starts=200,
         memory_size=500000,
-        num_iterations=6250000):
+        num_iterations=6250000,
+        prioritized=False,
+        replay_on_disk=False,
+        snapshot_replay=False,
+        n_step=1,
+        prefetch_depth=0,
+        shared_replay=False,
+        compress_replay=False,
+        replay_url=None,
+        workers_insert=False,
+        async_groups=0,
+        partial_agents=None,
+        step_timeout=None,
+        prefault_replay=False):
     events_path = os.path.join(base_path, 'events')
     models_path = os.path.join(base_path, 'models')
+    snapshot_path = os.path.join(base_path, 'replay_snapshots')
     if not os.path.exists(events_path):
         os.makedirs(events_path)
     if not os.path.exists(models_path):
@@ -64,9 +80,42 @@ def dqn(env,
         with open(pkl_path, 'rb') as f:
             rewards_history = pickle.load(f)
 
-    memory_buffer = Memory(memory_size)
+    replay_path = None
+    if replay_on_disk:
+        replay_path = os.path.join(base_path, 'replay')
+    if shared_replay:
+        replay_path = os.path.join('/dev/shm', os.path.basename(base_path))
+    if model.memory is not None:
+        # the estimator gathers its batches from its own GraphMemory
+        assert not (snapshot_replay or shared_replay or replay_url)
+        memory_buffer = model.memory
+    elif replay_url is not None:
+        # the replay server was started with the memory options
+        assert not (snapshot_replay or shared_replay)
+        memory_buffer = RemoteMemory(replay_url)
+        prioritized = memory_buffer.prioritized
+    else:
+        memory_class = PrioritizedMemory if prioritized else Memory
+        memory_buffer = memory_class(
+            memory_size,
+            env.num_agents,
+            path=replay_path,
+            n_step=n_step,
+            discount=model.discount,
+            compress=compress_replay,
+            state_dtype=env.obs_dtype)
+    if prefault_replay and replay_url is None:
+        # on the learner's NUMA node, before subagents write into it
+        memory_buffer.prefault()
+    if snapshot_replay:
+        memory_buffer.load(snapshot_path)
+    if shared_replay:
+        # subagents write their frames into the memory themselves
+        env.attach(memory_buffer)
+    env_inserts = shared_replay or workers_insert
     results_buffer = ResultsBuffer(rewards_history)
     global_step = model.get_global_step()
+    prefetcher = None
 
     try:
         states = env.reset()
@@ -74,22 +123,79 @@ def dqn(env,
             actions = model.get_action(states, epsilon)
             next_states, rewards, dones, info = env.step(actions)
 
-            memory_buffer.extend(
-                zip(states, actions, rewards, next_states, dones))
+            if not env_inserts:
+                memory_buffer.extend(
+                    (states, actions, rewards, next_states, dones))
             states = next_states
 
+        if prefetch_depth > 0:
+            prefetcher = Prefetcher(memory_buffer, batch_size, prefetch_depth)
+
         states = env.reset()
+        groups = None
+        if async_groups > 0:
+            # Every group has one step in flight, it steps while the other
+            # groups are acted on and the learner updates.
+            groups = env.groups(async_groups)
+            states = [states[agents] for agents in groups]
+            actions = [model.get_action(s, epsilon) for s in states]
+            for a, agents in zip(actions, groups):
+                env.step_async(a, agents)
+        partial = partial_agents is not None or step_timeout is not None
+        assert not (partial and groups)
+        if partial:
+            # agents step at their own pace, states follow their replies
+            states = np.array(states)
+            actions = np.zeros(env.num_agents, dtype=np.int64)
         start = time.time()
         for i in range(num_iterations):
-            actions = model.get_action(states, epsilon)
-            next_states, rewards, dones, info = env.step(actions)
-
-            results_buffer.update_infos(info, global_step)
-            memory_buffer.extend(
-                zip(states, actions, rewards, next_states, dones))
-
-            global_step, summaries = model.update(
-                *memory_buffer.sample(batch_size))
+            if partial:
+                agents = env.ready_agents()
+                actions[agents] = model.get_action(states[agents], epsilon)
+                agents, next_states, rewards, dones, info = env.step_ready(
+                    actions[agents], partial_agents, step_timeout)
+
+                results_buffer.update_infos(info, global_step)
+                if not env_inserts:
+                    memory_buffer.extend((states[agents], actions[agents],
+                                          rewards, next_states, dones),
+                                         agents)
+                states[agents] = next_states
+            elif groups is None:
+                actions = model.get_action(states, epsilon)
+                next_states, rewards, dones, info = env.step(actions)
+
+                results_buffer.update_infos(info, global_step)
+                if not env_inserts:
+                    memory_buffer.extend(
+                        (states, actions, rewards, next_states, dones))
+                states = next_states
+            else:
+                for k, agents in enumerate(groups):
+                    next_states, rewards, dones, info = env.step_wait(agents)
+
+                    results_buffer.update_infos(info, global_step)
+                    if not env_inserts:
+                        memory_buffer.extend(
+                            (states[k], actions[k], rewards, next_states,
+                             dones), np.arange(env.num_agents)[agents])
+                    states[k] = next_states
+                    actions[k] = model.get_action(next_states, epsilon)
+                    env.step_async(actions[k], agents)
+
+            if prefetcher is not None:
+                batch = prefetcher.get()
+            else:
+                batch = memory_buffer.sample(batch_size)
+            if prioritized:
+                indices, weights, batch = batch
+                global_step, summaries, errors = model.update(
+                    *batch, weight_batch=weights)
+                memory_buffer.update_priorities(indices, errors)
+                # full bias correction by the end of training
+                memory_buffer.anneal_beta(global_step / num_iterations)
+            else:
+                global_step, summaries, _ = model.update(*batch)
             results_buffer.update_summaries(summaries)
 
             if global_step % update_target_every == 0:
@@ -98,17 +204,32 @@ def dqn(env,
             if global_step % save_model_every == 0:
                 t = time.time() - start
                 model.save_model(models_path)
+                if snapshot_replay:
+                    memory_buffer.save(snapshot_path)
                 print("Save model, global_step: {}, delta_time: {}.".format(
                     global_step, t))
+                if prefetcher is not None:
+                    results_buffer.update_summaries(prefetcher.stats())
+                results_buffer.update_summaries(memory_buffer.stats())
+                results_buffer.update_summaries(env.stats())
+                table = env.throughput_table()
+                if table:
+                    print(table)
                 results_buffer.add_summary(summary_writer, global_step, t)
                 start = time.time()
 
-            states = next_states
-
     except Exception as e:
         raise e
 
     finally:
+        if prefetcher is not None:
+            prefetcher.close()
         model.save_model(models_path)
+        if snapshot_replay:
+            memory_buffer.save(snapshot_path)
         with open(pkl_path, 'wb') as f:
             pickle.dump(results_buffer.rewards_history, f)
+        if shared_replay:
+            shutil.rmtree(replay_path)
+        if replay_url is not None:
+            memory_buffer.close()
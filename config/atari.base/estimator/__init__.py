@@ -3,22 +3,36 @@ from .dqn import SoftDqn
 from .avedqn import AveDqn
 from .distdqn import DistDqn
 from .doubledqn import DoubleDqn
+from .graphmemory import GraphMemory
+from .graphmemory import PrioritizedGraphMemory
 
 
-def get_estimator(model_name, n_ac, lr, discount, **kwargs):
+def get_estimator(model_name,
+                  n_ac,
+                  lr,
+                  discount,
+                  memory=None,
+                  uint8_obs=False,
+                  tf_threads=(0, 0),
+                  **kwargs):
+    common = dict(
+        lr=lr,
+        discount=discount,
+        memory=memory,
+        uint8_obs=uint8_obs,
+        tf_threads=tf_threads)
     if model_name == 'dqn':
-        estimator = Dqn(n_ac, lr=lr, discount=discount)
+        estimator = Dqn(n_ac, **common)
     elif model_name == 'softdqn':
-        estimator = SoftDqn(n_ac, lr=lr, discount=discount, tau=kwargs['tau'])
+        estimator = SoftDqn(n_ac, tau=kwargs['tau'], **common)
     elif model_name == 'doubledqn':
-        estimator = DoubleDqn(n_ac, lr=lr, discount=discount)
+        estimator = DoubleDqn(n_ac, **common)
     elif model_name == 'distdqn':
-        estimator = DistDqn(
-            n_ac, lr=lr, discount=discount, vmax=10, vmin=-10, n_atoms=51)
+        estimator = DistDqn(n_ac, vmax=10, vmin=-10, n_atoms=51, **common)
 
     elif model_name.startswith('avedqn-'):
         k = int(model_name.split('-')[1])
-        estimator = AveDqn(n_ac, lr=lr, discount=discount, k=k)
+        estimator = AveDqn(n_ac, k=k, **common)
 
     else:
         raise Exception('{} is not supported!'.format(model_name))
@@ -10,22 +10,32 @@ class DistDqn(TFEstimator):
                  discount=0.99,
                  vmax=10,
                  vmin=-10,
-                 n_atoms=51):
+                 n_atoms=51,
+                 memory=None,
+                 uint8_obs=False,
+                 tf_threads=(0, 0)):
         self.n_atoms = n_atoms
         self.vmax = vmax
         self.vmin = vmin
         self.delta = (vmax - vmin) / (n_atoms - 1)
         self.split_points = np.linspace(vmin, vmax, n_atoms)
-        super(DistDqn, self).__init__(n_ac=n_ac, lr=lr, discount=discount)
+        super(DistDqn, self).__init__(
+            n_ac=n_ac,
+            lr=lr,
+            discount=discount,
+            memory=memory,
+            uint8_obs=uint8_obs,
+            tf_threads=tf_threads)
 
     def _build_model(self):
         # placeholders
-        self.input = tf.placeholder(
-            shape=[None, 84, 84, 4], dtype=tf.float32, name='inputs')
+        self.input = self._state_input()
         self.actions = tf.placeholder(
             shape=[None], dtype=tf.int32, name='actions')
         self.next_input = tf.placeholder(
             shape=[None, self.n_atoms], dtype=tf.float32, name='next_inputs')
+        self.weights = tf.placeholder(
+            shape=[None], dtype=tf.float32, name='weights')
 
         split_points = tf.constant(
             self.split_points, dtype=tf.float32, name='split_points')
@@ -51,8 +61,9 @@ class DistDqn(TFEstimator):
             tf.reshape(self.probs, [-1, self.n_atoms]), gather_indices)
         self.action_probs_clip = tf.clip_by_value(self.action_probs, 0.00001,
                                                   0.99999)
-        self.loss = tf.reduce_mean(-tf.reduce_sum(
-            self.next_input * tf.log(self.action_probs_clip), axis=-1))
+        self.cross_entropy = -tf.reduce_sum(
+            self.next_input * tf.log(self.action_probs_clip), axis=-1)
+        self.loss = tf.reduce_mean(self.weights * self.cross_entropy)
         self.train_op = self.optimizer.minimize(
             self.loss,
             global_step=tf.train.get_global_step(),
@@ -60,6 +71,8 @@ class DistDqn(TFEstimator):
         self.update_target_op = self._update_target_op()
 
     def _net(self, x, trainable=True):
+        if x.dtype == tf.uint8:
+            x = tf.cast(x, tf.float32) / 255.0
         conv1 = tf.contrib.layers.conv2d(
             x, 32, 8, 4, activation_fn=tf.nn.relu, trainable=trainable)
         conv2 = tf.contrib.layers.conv2d(
@@ -76,8 +89,8 @@ class DistDqn(TFEstimator):
             trainable=trainable)
         return fc2
 
-    def _calc_dist(self, reward, done, probs):
-        discount = self.discount * (1 - done)
+    def _calc_dist(self, reward, done, discount, probs):
+        discount = discount * (1 - done)
         m = np.zeros(self.n_atoms, dtype=np.float32)
         projections = (np.clip(reward + discount * self.split_points,
                                self.vmin, self.vmax) - self.vmin) / self.delta
@@ -89,27 +102,37 @@ class DistDqn(TFEstimator):
         return m
 
     def update(self, state_batch, action_batch, reward_batch, next_state_batch,
-               done_batch):
+               done_batch, discount_batch=None, weight_batch=None):
         batch_size = state_batch.shape[0]
+        if discount_batch is None:
+            discount_batch = np.full(batch_size, self.discount, np.float32)
+        if weight_batch is None:
+            weight_batch = np.ones(batch_size, dtype=np.float32)
         next_q_probs = self.sess.run(
-            self.probs_target, feed_dict={self.input: next_state_batch})
+            self.probs_target, feed_dict=self._state_feed(next_state_batch))
         next_q_vals = np.sum(next_q_probs * self.split_points, axis=-1)
         best_action = np.argmax(next_q_vals, axis=1)
 
         targets = np.array([
             self._calc_dist(*args)
-            for args in zip(reward_batch, done_batch, next_q_probs[np.arange(
-                batch_size), best_action])
+            for args in zip(reward_batch, done_batch, discount_batch,
+                            next_q_probs[np.arange(batch_size), best_action])
         ])
 
-        _, total_t, loss, max_q_value = self.sess.run(
+        feed_dict = self._state_feed(state_batch)
+        feed_dict.update({
+            self.actions: action_batch,
+            self.next_input: targets,
+            self.weights: weight_batch
+        })
+        _, total_t, loss, max_q_value, cross_entropy = self.sess.run(
             [
                 self.train_op,
-                tf.train.get_global_step(), self.loss, self.max_qval
+                tf.train.get_global_step(), self.loss, self.max_qval,
+                self.cross_entropy
             ],
-            feed_dict={
-                self.input: state_batch,
-                self.actions: action_batch,
-                self.next_input: targets
-            })
-        return total_t, {'loss': loss, 'max_q_value': max_q_value}
+            feed_dict=feed_dict)
+        return total_t, {
+            'loss': loss,
+            'max_q_value': max_q_value
+        }, cross_entropy
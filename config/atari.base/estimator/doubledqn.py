@@ -5,24 +5,31 @@ from .dqn import Dqn
 
 class DoubleDqn(Dqn):
     def update(self, state_batch, action_batch, reward_batch, next_state_batch,
-               done_batch):
+               done_batch, discount_batch=None, weight_batch=None):
         batch_size = state_batch.shape[0]
+        if discount_batch is None:
+            discount_batch = np.full(batch_size, self.discount, np.float32)
+        if weight_batch is None:
+            weight_batch = np.ones(batch_size, dtype=np.float32)
         next_q_vals, target_next_q_vals = self.sess.run(
             [self.qvals, self.target_qvals],
-            feed_dict={self.input: next_state_batch})
+            feed_dict=self._state_feed(next_state_batch))
         best_action = np.argmax(next_q_vals, axis=1)
 
         targets = reward_batch + (
-            1 - done_batch) * self.discount * target_next_q_vals[np.arange(
+            1 - done_batch) * discount_batch * target_next_q_vals[np.arange(
                 batch_size), best_action]
-        _, total_t, loss, max_q_value = self.sess.run(
+        feed_dict = self._state_feed(state_batch)
+        feed_dict.update({
+            self.actions: action_batch,
+            self.next_input: targets,
+            self.weights: weight_batch
+        })
+        _, total_t, loss, max_q_value, td_errors = self.sess.run(
             [
                 self.train_op,
-                tf.train.get_global_step(), self.loss, self.max_qval
+                tf.train.get_global_step(), self.loss, self.max_qval,
+                self.td_errors
             ],
-            feed_dict={
-                self.input: state_batch,
-                self.actions: action_batch,
-                self.next_input: targets
-            })
-        return total_t, {'loss': loss, 'max_q_value': max_q_value}
+            feed_dict=feed_dict)
+        return total_t, {'loss': loss, 'max_q_value': max_q_value}, td_errors
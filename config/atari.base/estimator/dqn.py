@@ -1,20 +1,29 @@
+import numpy as np
 import tensorflow as tf
 from .tfestimator import TFEstimator
 
 
 class Dqn(TFEstimator):
-    def __init__(self, n_ac, lr=1e-4, discount=0.99):
-        super(Dqn, self).__init__(n_ac, lr, discount)
+    def __init__(self,
+                 n_ac,
+                 lr=1e-4,
+                 discount=0.99,
+                 memory=None,
+                 uint8_obs=False,
+                 tf_threads=(0, 0)):
+        super(Dqn, self).__init__(n_ac, lr, discount, memory, uint8_obs,
+                                  tf_threads)
         self.update_target()
 
     def _build_model(self):
         # placeholders
-        self.input = tf.placeholder(
-            shape=[None, 84, 84, 4], dtype=tf.float32, name='inputs')
+        self.input = self._state_input()
         self.actions = tf.placeholder(
             shape=[None], dtype=tf.int32, name='actions')
         self.next_input = tf.placeholder(
             shape=[None], dtype=tf.float32, name='next_inputs')
+        self.weights = tf.placeholder(
+            shape=[None], dtype=tf.float32, name='weights')
 
         # network
         with tf.variable_scope('qnet'):
@@ -26,8 +35,8 @@ class Dqn(TFEstimator):
         batch_size = tf.shape(self.input)[0]
         gather_indices = tf.range(batch_size) * self.n_ac + self.actions
         action_q = tf.gather(tf.reshape(self.qvals, [-1]), gather_indices)
-        self.loss = tf.reduce_mean(
-            tf.squared_difference(self.next_input, action_q))
+        self.td_errors = self.next_input - action_q
+        self.loss = tf.reduce_mean(self.weights * tf.square(self.td_errors))
         self.max_qval = tf.reduce_max(self.qvals)
 
         self.train_op = self.optimizer.minimize(
@@ -49,24 +58,31 @@ class Dqn(TFEstimator):
         return update_ops
 
     def update(self, state_batch, action_batch, reward_batch, next_state_batch,
-               done_batch):
-        # batch_size = state_batch.shape[0]
+               done_batch, discount_batch=None, weight_batch=None):
+        batch_size = state_batch.shape[0]
+        if discount_batch is None:
+            discount_batch = np.full(batch_size, self.discount, np.float32)
+        if weight_batch is None:
+            weight_batch = np.ones(batch_size, dtype=np.float32)
         target_next_q_vals = self.sess.run(
-            self.target_qvals, feed_dict={self.input: next_state_batch})
+            self.target_qvals, feed_dict=self._state_feed(next_state_batch))
 
         targets = reward_batch + (
-            1 - done_batch) * self.discount * target_next_q_vals.max(axis=1)
-        _, total_t, loss, max_q_value = self.sess.run(
+            1 - done_batch) * discount_batch * target_next_q_vals.max(axis=1)
+        feed_dict = self._state_feed(state_batch)
+        feed_dict.update({
+            self.actions: action_batch,
+            self.next_input: targets,
+            self.weights: weight_batch
+        })
+        _, total_t, loss, max_q_value, td_errors = self.sess.run(
             [
                 self.train_op,
-                tf.train.get_global_step(), self.loss, self.max_qval
+                tf.train.get_global_step(), self.loss, self.max_qval,
+                self.td_errors
             ],
-            feed_dict={
-                self.input: state_batch,
-                self.actions: action_batch,
-                self.next_input: targets
-            })
-        return total_t, {'loss': loss, 'max_q_value': max_q_value}
+            feed_dict=feed_dict)
+        return total_t, {'loss': loss, 'max_q_value': max_q_value}, td_errors
 
     def update_target(self):
         self.sess.run(self.update_target_op)
@@ -76,18 +92,27 @@ class Dqn(TFEstimator):
 
 
 class SoftDqn(TFEstimator):
-    def __init__(self, n_ac, lr=1e-4, discount=0.99, tau=0.001):
+    def __init__(self,
+                 n_ac,
+                 lr=1e-4,
+                 discount=0.99,
+                 tau=0.001,
+                 memory=None,
+                 uint8_obs=False,
+                 tf_threads=(0, 0)):
         self.tau = tau
-        TFEstimator.__init__(self, n_ac, lr, discount)
+        TFEstimator.__init__(self, n_ac, lr, discount, memory, uint8_obs,
+                             tf_threads)
 
     def _build_model(self):
         # placeholders
-        self.input = tf.placeholder(
-            shape=[None, 84, 84, 4], dtype=tf.float32, name='inputs')
+        self.input = self._state_input()
         self.actions = tf.placeholder(
             shape=[None], dtype=tf.int32, name='actions')
         self.next_input = tf.placeholder(
             shape=[None], dtype=tf.float32, name='next_inputs')
+        self.weights = tf.placeholder(
+            shape=[None], dtype=tf.float32, name='weights')
 
         # network
         with tf.variable_scope('qnet'):
@@ -99,8 +124,8 @@ class SoftDqn(TFEstimator):
         batch_size = tf.shape(self.input)[0]
         gather_indices = tf.range(batch_size) * self.n_ac + self.actions
         action_q = tf.gather(tf.reshape(self.qvals, [-1]), gather_indices)
-        self.loss = tf.reduce_mean(
-            tf.squared_difference(self.next_input, action_q))
+        self.td_errors = self.next_input - action_q
+        self.loss = tf.reduce_mean(self.weights * tf.square(self.td_errors))
         self.max_qval = tf.reduce_max(self.qvals)
 
         train_op = self.optimizer.minimize(
@@ -127,24 +152,31 @@ class SoftDqn(TFEstimator):
         return update_ops
 
     def update(self, state_batch, action_batch, reward_batch, next_state_batch,
-               done_batch):
-        # batch_size = state_batch.shape[0]
+               done_batch, discount_batch=None, weight_batch=None):
+        batch_size = state_batch.shape[0]
+        if discount_batch is None:
+            discount_batch = np.full(batch_size, self.discount, np.float32)
+        if weight_batch is None:
+            weight_batch = np.ones(batch_size, dtype=np.float32)
         target_next_q_vals = self.sess.run(
-            self.target_qvals, feed_dict={self.input: next_state_batch})
+            self.target_qvals, feed_dict=self._state_feed(next_state_batch))
 
         targets = reward_batch + (
-            1 - done_batch) * self.discount * target_next_q_vals.max(axis=1)
-        _, total_t, loss, max_q_value = self.sess.run(
+            1 - done_batch) * discount_batch * target_next_q_vals.max(axis=1)
+        feed_dict = self._state_feed(state_batch)
+        feed_dict.update({
+            self.actions: action_batch,
+            self.next_input: targets,
+            self.weights: weight_batch
+        })
+        _, total_t, loss, max_q_value, td_errors = self.sess.run(
             [
                 self.train_op,
-                tf.train.get_global_step(), self.loss, self.max_qval
+                tf.train.get_global_step(), self.loss, self.max_qval,
+                self.td_errors
             ],
-            feed_dict={
-                self.input: state_batch,
-                self.actions: action_batch,
-                self.next_input: targets
-            })
-        return total_t, {'loss': loss, 'max_q_value': max_q_value}
+            feed_dict=feed_dict)
+        return total_t, {'loss': loss, 'max_q_value': max_q_value}, td_errors
 
     def update_target(self):
         pass
@@ -0,0 +1,106 @@
+import numpy as np
+import tensorflow as tf
+from memory import Memory, PrioritizedMemory
+
+
+class GraphMemory(Memory):
+    """Replay memory whose frames live in a TF variable of the estimator.
+
+    Bookkeeping stays in numpy, but frames are uploaded once, with one
+    scatter per env step, and batches only hold the frame indices of their
+    stacks. The estimator gathers and scales the stacks inside its graph, so
+    no state batch goes through `feed_dict`.
+
+    Frames are gathered when the batch is used, a prefetched batch may thus
+    see a few of its oldest rows already overwritten.
+    """
+
+    def __init__(self, capacity, num_agents=1, **kwargs):
+        assert kwargs.get('path') is None and not kwargs.get('compress')
+        super(GraphMemory, self).__init__(capacity, num_agents, **kwargs)
+        # newest frame of every agent, for the stream continuity check
+        self.newest = np.zeros(
+            (self.num_agents, ) + self.frame_shape, dtype=np.uint8)
+        self.pending = []
+        self.sess = None
+
+    def build(self, sess):
+        """Create the frame variable in the current graph.
+
+        Returns the uint8 stacks gathered at the fed `indices`.
+        """
+        self.sess = sess
+        with tf.variable_scope('replay'):
+            self.frames = tf.Variable(
+                tf.zeros((self.num_agents * self.size, ) + self.frame_shape,
+                         dtype=tf.uint8),
+                trainable=False,
+                name='frames')
+            self.indices = tf.placeholder(
+                shape=[None, self.stack], dtype=tf.int32, name='indices')
+            self.new_indices = tf.placeholder(
+                shape=[None], dtype=tf.int32, name='new_indices')
+            self.new_frames = tf.placeholder(
+                shape=(None, ) + self.frame_shape,
+                dtype=tf.uint8,
+                name='new_frames')
+            self.upload_op = tf.scatter_update(self.frames, self.new_indices,
+                                               self.new_frames)
+            stacks = tf.gather(self.frames, self.indices)
+            return tf.transpose(stacks, [0, 2, 3, 1])
+
+    def _alloc_frames(self, shape):
+        return None
+
+    def _newest_frames(self, agents):
+        return self.newest[agents]
+
+    def _put_frames(self, indices, frames):
+        self.pending.append((indices, frames))
+        self.newest[indices // self.size] = frames
+
+    def _insert(self, *args):
+        super(GraphMemory, self)._insert(*args)
+        self._upload()
+
+    def _upload(self):
+        indices = np.concatenate([i for i, _ in self.pending])
+        frames = np.concatenate([f for _, f in self.pending])
+        self.pending = []
+        # a row written twice in one step keeps its last frame
+        _, last = np.unique(indices[::-1], return_index=True)
+        last = len(indices) - 1 - last
+        self.sess.run(
+            self.upload_op,
+            feed_dict={
+                self.new_indices: indices[last],
+                self.new_frames: frames[last]
+            })
+
+    def _frames_nbytes(self):
+        return (self.num_agents * self.size * int(np.prod(self.frame_shape))
+                + self.newest.nbytes)
+
+    def new_batch(self, batch_size):
+        shape = (batch_size, self.stack)
+        batch = (np.empty(shape, dtype=np.int32),
+                 np.empty(batch_size, dtype=np.int32),
+                 np.empty(batch_size, dtype=np.float32),
+                 np.empty(shape, dtype=np.int32),
+                 np.empty(batch_size, dtype=np.float32))
+        if self.n_step > 1:
+            batch += (np.empty(batch_size, dtype=np.float32), )
+        return batch
+
+    def _gather_stacks(self, agents, rows, out):
+        out[...] = self._stack_indices(agents, rows)
+
+    def save(self, path):
+        raise Exception('snapshots of a GraphMemory are not supported!')
+
+    def load(self, path):
+        raise Exception('snapshots of a GraphMemory are not supported!')
+
+
+class PrioritizedGraphMemory(GraphMemory, PrioritizedMemory):
+    """Proportional prioritized replay with its frames in the graph."""
@@ -4,9 +4,21 @@ import tensorflow as tf
 
 
 class TFEstimator(object):
-    def __init__(self, n_ac, lr=1e-4, discount=0.99):
+    def __init__(self,
+                 n_ac,
+                 lr=1e-4,
+                 discount=0.99,
+                 memory=None,
+                 uint8_obs=False,
+                 tf_threads=(0, 0)):
         self.n_ac = n_ac
         self.discount = discount
+        # states are fed as uint8 pixels and scaled inside the graph
+        self.uint8_obs = uint8_obs
+        # a GraphMemory whose batches are gathered inside the graph
+        self.memory = memory
+        # sizes of TF's intra and inter op thread pools, 0 lets TF choose
+        self.tf_threads = tf_threads
         self.optimizer = tf.train.AdamOptimizer(lr, epsilon=1.5e-4)
         self._prepare()
 
@@ -14,7 +26,10 @@ class TFEstimator(object):
         tf.reset_default_graph()
         tf.Variable(0, name='global_step', trainable=False)
         self.saver = tf.train.Saver(max_to_keep=5)
-        config = tf.ConfigProto(allow_soft_placement=True)
+        config = tf.ConfigProto(
+            allow_soft_placement=True,
+            intra_op_parallelism_threads=self.tf_threads[0],
+            inter_op_parallelism_threads=self.tf_threads[1])
         config.gpu_options.allow_growth = True
         self.sess = tf.Session(config=config)
 
@@ -33,7 +48,27 @@ class TFEstimator(object):
     def get_qvals(self, obs):
         raise NotImplementedError
 
+    def _state_input(self):
+        dtype = tf.uint8 if self.uint8_obs else tf.float32
+        if self.memory is None:
+            return tf.placeholder(
+                shape=[None, 84, 84, 4], dtype=dtype, name='inputs')
+        # stacks are gathered from the replay unless states are fed
+        stacks = self.memory.build(self.sess)
+        if not self.uint8_obs:
+            stacks = tf.cast(stacks, tf.float32) / 255.0
+        return tf.placeholder_with_default(
+            stacks, [None, 84, 84, 4], name='inputs')
+
+    def _state_feed(self, states):
+        """Feed a batch of states, or their frame indices in the memory."""
+        if self.memory is None:
+            return {self.input: states}
+        return {self.memory.indices: states}
+
     def _net(self, x, trainable=True):
+        if x.dtype == tf.uint8:
+            x = tf.cast(x, tf.float32) / 255.0
         conv1 = tf.contrib.layers.conv2d(
             x, 32, 8, 4, activation_fn=tf.nn.relu, trainable=trainable)
         conv2 = tf.contrib.layers.conv2d(
@@ -0,0 +1,69 @@
+import numpy as np
+from collections import deque
+from subagent import SubAgent
+
+
+class LocalAgent(object):
+    """Step all agents' environments inside the learner process.
+
+    A stand-in for `Agent` in synchronous `reset` and `step` loops, without
+    subagent processes, sockets or serialization, for small runs, tests and
+    profiling. The environments are those of one `SubAgent`, stepped on
+    `num_threads` threads, one per env by default, or in a loop with 1.
+
+    `step` fills one of two preallocated batches in turn, so the states it
+    returns stay valid until the step after next.
+    """
+
+    def __init__(self, num_agents, game_name, uint8_obs=False,
+                 hot_spares=False, num_threads=None):
+        self.num_agents = num_agents
+        self.envs = SubAgent(
+            game_name,
+            0,
+            None,
+            uint8_obs=uint8_obs,
+            num_envs=num_agents,
+            hot_spares=hot_spares,
+            num_threads=num_threads)
+        self.action_n = self.envs.action_n
+        self.state_shape = self.envs.envs[0].observation_space.shape
+        self.obs_dtype = np.uint8 if uint8_obs else np.float32
+        shape = (2, num_agents)
+        self.states = np.empty(shape + self.state_shape, dtype=self.obs_dtype)
+        self.rewards = np.empty(shape, dtype=np.float32)
+        self.dones = np.empty(shape, dtype=np.bool_)
+        self.half = 0
+        # recent protocol.TIMING like step timings, cleared by `stats`
+        self._timings = deque(maxlen=1000)
+
+    def reset(self):
+        return self.envs.reset()
+
+    def step(self, actions):
+        self.half ^= 1
+        out = (self.states[self.half], self.rewards[self.half],
+               self.dones[self.half])
+        states, rewards, dones, infos = self.envs.step(actions, out)
+        self._timings.append(self.envs.step_timing)
+        info = {j: msg for j, msg in enumerate(infos) if msg}
+        return states, rewards, dones, info
+
+    def stats(self):
+        """Step, emulation and preprocessing percentiles, in ms."""
+        if not self._timings:
+            return {}
+        timings = np.array(self._timings) * 1000
+        self._timings.clear()
+        s = {}
+        for name, times in zip(('step', 'emulate', 'preprocess'), timings.T):
+            for q in (50, 90, 99):
+                s['worker_{}_ms_p{}'.format(name, q)] = np.percentile(times, q)
+        return s
+
+    def throughput_table(self):
+        # a single worker
+        return ''
+
+    def close(self):
+        self.envs.close()
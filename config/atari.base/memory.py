@@ -1,19 +1,767 @@
-import random
+import os
+import glob
+import time
+import zlib
+import queue
+import threading
 import numpy as np
-from collections import deque
+from collections import OrderedDict, deque
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
+
+def compress(data):
+    if lz4 is not None:
+        return lz4.compress(data)
+    return zlib.compress(data, 1)
+
+
+def decompress(data):
+    if lz4 is not None:
+        return lz4.decompress(data)
+    return zlib.decompress(data)
+
+
+def quantize(states):
+    """Map observations scaled to [0, 1] back to their uint8 pixels."""
+    if states.dtype == np.uint8:
+        return states
+    return np.rint(states * 255).astype(np.uint8)
+
+
+def available_ram(meminfo='/proc/meminfo'):
+    """Bytes that can be allocated without swapping.
+
+    MemAvailable counts the reclaimable page cache, MemFree does not and
+    is only the fallback where /proc/meminfo does not tell.
+    """
+    if os.path.exists(meminfo):
+        with open(meminfo) as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
 
 
 class Memory(object):
+    """Replay memory keeping every 84x84 frame once, as uint8.
+
+    Each agent owns a ring of `capacity // num_agents` rows. Row `j` holds the
+    newest frame of the state seen at step `j` together with the action, reward
+    and done taken from it. Stacked states and next states are rebuilt from the
+    neighbouring rows, stopping at episode starts.
+
+    With `n_step > 1` the reward of a row is the discounted sum of the next
+    `n_step` rewards of its agent, accumulated as they are inserted, and
+    `sample` also returns the discount of the bootstrap state.
+
+    With `path` set the arrays are `np.memmap` files in that directory, so RAM
+    only serves as page cache and capacity is bounded by disk instead.
+
+    With `compress` every frame is kept lz4 (or zlib) compressed, and the
+    last `cache_size` frames used are kept decoded in an LRU cache.
+
+    States are returned as float32 in [0, 1], or as the stored uint8 pixels
+    with `state_dtype=np.uint8`.
+
+    Capacity held in RAM is checked against the available memory up front,
+    use `row_bytes` to size a memory by a byte budget instead.
+    """
+
+    def __init__(self,
+                 capacity,
+                 num_agents=1,
+                 frame_shape=(84, 84),
+                 stack=4,
+                 path=None,
+                 n_step=1,
+                 discount=0.99,
+                 compress=False,
+                 cache_size=4096,
+                 state_dtype=np.float32):
+        self.num_agents = num_agents
+        self.size = capacity // num_agents
+        self.stack = stack
+        self.n_step = n_step
+        self.path = path
+        self.compress = compress
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.state_dtype = state_dtype
+        self.frame_shape = tuple(frame_shape)
+        assert self.size > max(stack, n_step)
+        assert not (compress and path is not None)
+        self._check_ram(capacity)
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path)
+
+        shape = (num_agents, self.size)
+        self.frames = self._alloc_frames(shape)
+        self.actions = self._alloc('actions', shape, np.int32)
+        self.rewards = self._alloc('rewards', shape, np.float32)
+        self.dones = self._alloc('dones', shape, np.float32)
+        # steps from a row to its bootstrap row, at most n_step
+        self.horizons = self._alloc('horizons', shape, np.uint8)
+        # first frame of an episode, older rows are not part of its stacks
+        self.starts = self._alloc('starts', shape, np.bool_)
+        # row holds a complete transition and its next frame is stored
+        self.valid = self._alloc('valid', shape, np.bool_)
+        # number of rows ever written by each agent
+        self.count = np.zeros(num_agents, dtype=np.int64)
+        # `count` at the last snapshot
+        self.saved = np.zeros(num_agents, dtype=np.int64)
+        # times each row was sampled since it was written
+        self.uses = np.zeros(shape, dtype=np.int32)
+
+        # transitions since each agent's stream was last broken
+        self.run = np.zeros(num_agents, dtype=np.int64)
+        self.discounts = discount**np.arange(n_step + 1, dtype=np.float32)
+
+        # guards against a Prefetcher sampling while the learner inserts
+        self.lock = threading.Lock()
+        self._agents = np.arange(num_agents)
+        self._batches = {}
+        self._scratch = {}
+        # recent samples, reported and cleared by `stats`
+        self._sample_times = deque(maxlen=1000)
+        self._ages = deque(maxlen=1000)
+        self._reuses = deque(maxlen=1000)
+
+    @classmethod
+    def row_bytes(cls, frame_shape=(84, 84)):
+        """Bytes one uncompressed transition takes."""
+        # frame, action, reward, done, horizon, start, valid and uses
+        return int(np.prod(frame_shape)) + 4 + 4 + 4 + 1 + 1 + 1 + 4
+
+    def _check_ram(self, capacity):
+        # memmaps outside /dev/shm are paged out to disk, compressed frames
+        # take an unknown fraction of their size
+        if self.compress or not (self.path is None
+                                 or self.path.startswith('/dev/shm')):
+            return
+        need = self.num_agents * self.size * self.row_bytes(self.frame_shape)
+        avail = available_ram()
+        if need > avail:
+            raise Exception(
+                'replay memory of {} transitions needs {:.1f} GB, only {:.1f} '
+                'GB are available!'.format(capacity, need / 2**30,
+                                           avail / 2**30))
+
+    def _alloc(self, name, shape, dtype):
+        if self.path is None:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(
+            os.path.join(self.path, '{}.bin'.format(name)),
+            dtype=dtype,
+            mode='w+',
+            shape=shape)
+
+    def _alloc_frames(self, shape):
+        if self.compress:
+            empty = compress(np.zeros(self.frame_shape, np.uint8).tobytes())
+            return np.full(shape, empty, dtype=object)
+        return self._alloc('frames', shape + self.frame_shape, np.uint8)
+
+    def _get_frames(self, indices, out=None):
+        """Frames at flat `agent * size + row` indices."""
+        if not self.compress:
+            return np.take(
+                self.frames.reshape((-1, ) + self.frame_shape),
+                indices,
+                axis=0,
+                out=out)
+
+        if out is None:
+            out = np.empty(indices.shape + self.frame_shape, np.uint8)
+        # stacks overlap, decode every distinct frame of the batch once
+        unique, inverse = np.unique(indices, return_inverse=True)
+        frames = np.stack([self._decode(i) for i in unique])
+        np.take(
+            frames,
+            inverse.reshape(-1),
+            axis=0,
+            out=out.reshape((-1, ) + self.frame_shape))
+        return out
+
+    def _put_frames(self, indices, frames):
+        if not self.compress:
+            self.frames.reshape((-1, ) + self.frame_shape)[indices] = frames
+            return
+        flat = self.frames.reshape(-1)
+        for i, frame in zip(indices, frames):
+            flat[i] = compress(frame.tobytes())
+            self._cache_frame(i, frame.copy())
+
+    def _decode(self, index):
+        frame = self.cache.get(index)
+        if frame is not None:
+            self.cache.move_to_end(index)
+            return frame
+        frame = np.frombuffer(
+            decompress(self.frames.reshape(-1)[index]),
+            dtype=np.uint8).reshape(self.frame_shape)
+        self._cache_frame(index, frame)
+        return frame
+
+    def _cache_frame(self, index, frame):
+        self.cache[index] = frame
+        self.cache.move_to_end(index)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def __len__(self):
+        return int(np.minimum(self.count, self.size).sum())
+
+    def append(self, transition, agent=0):
+        self._insert(np.array([agent]), *[np.array([x]) for x in transition])
+
+    def extend(self, transitions, agents=None):
+        """Insert one transition per agent, in agent order.
+
+        `transitions` is either an iterable of `(state, action, reward,
+        next_state, done)` tuples or that tuple of batched arrays. They come
+        from the first agents unless `agents` says which ones.
+        """
+        if not (isinstance(transitions, tuple)
+                and isinstance(transitions[0], np.ndarray)):
+            transitions = list(map(np.array, zip(*transitions)))
+        if agents is None:
+            agents = self._agents[:len(transitions[0])]
+        self._insert(np.asarray(agents), *transitions)
+
+    def reserve(self, agents):
+        """Return the rows an outside writer must put the next frames in.
+
+        Used when env workers write frames straight into a shared `path`;
+        `commit` or `commit_reset` then records the step.
+        """
+        with self.lock:
+            return self._claim(agents)
+
+    def commit(self, agents, rows, actions, rewards, dones):
+        with self.lock:
+            self._record(agents, actions, rewards, dones)
+            self._advance(agents, rows, dones)
+
+    def commit_reset(self, agents, rows):
+        with self.lock:
+            self.run[agents] = 0
+            self._advance(agents, rows, True)
+
+    def states(self, agents):
+        """Stacked current states of `agents`, rebuilt from their rows."""
+        with self.lock:
+            rows = (self.count[agents] - 1) % self.size
+            states = np.empty(
+                (len(agents), ) + self.frame_shape + (self.stack, ),
+                dtype=self.state_dtype)
+            self._gather_stacks(agents, rows, states)
+        return states
+
+    def new_batch(self, batch_size):
+        """Allocate arrays that `sample` can fill in place."""
+        shape = (batch_size, ) + self.frame_shape + (self.stack, )
+        batch = (np.empty(shape, dtype=self.state_dtype),
+                 np.empty(batch_size, dtype=np.int32),
+                 np.empty(batch_size, dtype=np.float32),
+                 np.empty(shape, dtype=self.state_dtype),
+                 np.empty(batch_size, dtype=np.float32))
+        if self.n_step > 1:
+            batch += (np.empty(batch_size, dtype=np.float32), )
+        return batch
+
+    def sample(self, batch_size, out=None):
+        """Sample a batch into `out`, or into arrays reused across calls."""
+        with self.lock:
+            start = time.time()
+            batch = self._gather(*self._sample_indices(batch_size),
+                                 out=self._output(batch_size, out))
+            self._sample_times.append(time.time() - start)
+        return batch
+
+    def _arrays(self):
+        return [self.actions, self.rewards, self.dones, self.horizons,
+                self.starts, self.valid, self.uses]
+
+    def nbytes(self):
+        """Bytes held by the arrays, compressed frames and decode cache."""
+        return (sum(x.nbytes for x in self._arrays())
+                + self._frames_nbytes())
+
+    def prefault(self):
+        """Allocate every page of the arrays from the calling thread.
+
+        Linux places a page on the NUMA node of the CPU first writing it, so
+        called from a pinned learner the rows stay on its node, including
+        frames later written by subagents into a shared memory.
+        """
+        if self.path is not None and not self.path.startswith('/dev/shm'):
+            # pages of memmaps on disk come and go with the page cache
+            return
+        arrays = self._arrays()
+        if isinstance(self.frames, np.ndarray) and not self.compress:
+            arrays.append(self.frames)
+        page = os.sysconf('SC_PAGE_SIZE')
+        for x in arrays:
+            flat = x.reshape(-1).view(np.uint8)
+            # rewrite one byte per page, keeping what is stored
+            flat[::page] = flat[::page]
+
+    def _frames_nbytes(self):
+        if not self.compress:
+            return self.frames.nbytes
+        frame = int(np.prod(self.frame_shape))
+        return (self.frames.nbytes
+                + sum(len(f) for f in self.frames.reshape(-1))
+                + len(self.cache) * frame)
+
+    def stats(self):
+        """Size, fill level and what was sampled since the last call."""
+        with self.lock:
+            return self._stats()
+
+    def _stats(self):
+        s = {
+            'replay_bytes': self.nbytes(),
+            'replay_fill': len(self) / (self.num_agents * self.size)
+        }
+        if self._sample_times:
+            times = np.array(self._sample_times) * 1000
+            for q in (50, 90, 99):
+                s['replay_sample_ms_p{}'.format(q)] = np.percentile(times, q)
+        if self._ages:
+            ages = np.concatenate(self._ages)
+            for q in (50, 90):
+                s['replay_age_p{}'.format(q)] = np.percentile(ages, q)
+        if self._reuses:
+            # times a transition was sampled before it was overwritten
+            s['replay_reuse_mean'] = np.mean(np.concatenate(self._reuses))
+        self._sample_times.clear()
+        self._ages.clear()
+        self._reuses.clear()
+        return s
+
+    def save(self, path):
+        """Append the rows written since the last snapshot as a new chunk.
+
+        Chunks whose rows have all been overwritten since are deleted.
+        """
+        with self.lock:
+            self._save(path)
+
+    def _save(self, path):
+        if np.all(self.count == self.saved):
+            return
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # rows still short of n_step and the pending row of the last chunk
+        # changed since, resend them
+        first = np.maximum(self.saved - self.n_step, self.count - self.size)
+        first = np.maximum(first, 0)
+        lengths = self.count - first
+        agents = np.repeat(self._agents, lengths)
+        index = np.concatenate(
+            [np.arange(f, c) for f, c in zip(first, self.count)])
+        rows = index % self.size
+
+        chunks = self._chunks(path)
+        seq = int(os.path.basename(chunks[-1])[6:-4]) + 1 if chunks else 0
+        name = os.path.join(path, 'chunk-{:08d}.npz'.format(seq))
+        with open(name + '.tmp', 'wb') as f:
+            np.savez(
+                f,
+                count=self.count,
+                size=self.size,
+                agents=agents,
+                index=index,
+                frames=self._get_frames(agents * self.size + rows),
+                actions=self.actions[agents, rows],
+                rewards=self.rewards[agents, rows],
+                dones=self.dones[agents, rows],
+                horizons=self.horizons[agents, rows],
+                starts=self.starts[agents, rows],
+                valid=self.valid[agents, rows])
+        os.rename(name + '.tmp', name)
+        self.saved = self.count.copy()
+
+        for chunk in chunks:
+            with np.load(chunk) as c:
+                if np.all(c['count'] <= self.count - c['size']):
+                    os.remove(chunk)
+
+    def load(self, path):
+        """Rebuild the memory from the chunks written by `save`."""
+        chunks = self._chunks(path)
+        if not chunks:
+            return
+        with np.load(chunks[-1]) as c:
+            count = c['count']
+        assert len(count) == self.num_agents
+
+        oldest = np.full(self.num_agents, np.iinfo(np.int64).max)
+        for chunk in chunks:
+            with np.load(chunk) as c:
+                agents, index = c['agents'], c['index']
+                keep = index >= count[agents] - self.size
+                agents, index = agents[keep], index[keep]
+                rows = index % self.size
+                np.minimum.at(oldest, agents, index)
+                self._put_frames(agents * self.size + rows,
+                                 c['frames'][keep])
+                for name in ('actions', 'rewards', 'dones', 'horizons',
+                             'starts', 'valid'):
+                    getattr(self, name)[agents, rows] = c[name][keep]
+
+        # stacks of the oldest rows reach back past what was kept
+        oldest = np.minimum(oldest, count)
+        for i in range(self.stack - 1):
+            self.valid[self._agents, (oldest + i) % self.size] = False
+        self.count = count.copy()
+        self.saved = count.copy()
+        self.run[:] = 0
+        self._set_valid(*np.indices(self.valid.shape).reshape(2, -1),
+                        self.valid.reshape(-1))
+        print('Loaded {} transitions from {}.'.format(
+            int(self.valid.sum()), path))
+
+    @staticmethod
+    def _chunks(path):
+        return sorted(glob.glob(os.path.join(path, 'chunk-*.npz')))
+
+    def _output(self, batch_size, out):
+        if out is None:
+            if batch_size not in self._batches:
+                self._batches[batch_size] = self.new_batch(batch_size)
+            out = self._batches[batch_size]
+        return out
+
+    def _gather(self, agents, rows, out):
+        states, actions, rewards, next_states, dones = out[:5]
+        indices = agents * self.size + rows
+        horizons = self.horizons.reshape(-1)[indices]
+        # in steps of the agent, not counting segment start rows
+        self._ages.append((self.count[agents] - 1 - rows) % self.size)
+        np.add.at(self.uses.reshape(-1), indices, 1)
+        self._gather_stacks(agents, rows, states)
+        self._gather_stacks(agents, (rows + horizons) % self.size,
+                            next_states)
+        np.take(self.actions.reshape(-1), indices, out=actions)
+        np.take(self.rewards.reshape(-1), indices, out=rewards)
+        np.take(self.dones.reshape(-1), indices, out=dones)
+        if self.n_step > 1:
+            np.take(self.discounts, horizons, out=out[5])
+        return out
+
+    def _gather_stacks(self, agents, rows, out):
+        frames = self._scratch.get(len(rows))
+        if frames is None:
+            frames = np.empty(
+                (len(rows), self.stack) + self.frame_shape, np.uint8)
+            self._scratch[len(rows)] = frames
+        self._get_frames(self._stack_indices(agents, rows), out=frames)
+        # channel by channel, a transposing copy is several times slower
+        for i in range(self.stack):
+            if out.dtype == np.uint8:
+                out[..., i] = frames[:, i]
+            else:
+                np.divide(frames[:, i], np.float32(255.0), out=out[..., i])
+
+    def _insert(self, *args):
+        with self.lock:
+            self._insert_locked(*args)
+
+    def _insert_locked(self, agents, states, actions, rewards, next_states,
+                       dones):
+        assert len(agents) <= self.num_agents
+        frames = quantize(states[..., -1])
+
+        # The pending row of an agent already holds the newest frame of
+        # `states` unless its stream was broken, e.g. by env.reset(); then a
+        # new segment is started from the whole stack.
+        cont = np.all(self._newest_frames(agents) == frames, axis=(1, 2))
+        cont &= self.count[agents] > 0
+        for i in np.flatnonzero(~cont):
+            self._start_segment(agents[i], quantize(states[i]))
+
+        self._record(agents, actions, rewards, dones)
+        # After done the next state is a freshly reset stack, which the
+        # start flag reproduces from its single frame.
+        self._write_frames(agents, quantize(next_states[..., -1]),
+                           dones)
+
+    def _newest_frames(self, agents):
+        last = (self.count[agents] - 1) % self.size
+        return self._get_frames(agents * self.size + last)
+
+    def _record(self, agents, actions, rewards, dones):
+        """Complete the transition leaving the pending rows."""
+        rows = (self.count[agents] - 1) % self.size
+        self.actions[agents, rows] = actions
+        self.rewards[agents, rows] = rewards
+        self.dones[agents, rows] = dones
+        self.horizons[agents, rows] = 1
+        if self.n_step > 1:
+            self._accumulate(agents, rows, rewards, dones)
+        self.run[agents] += 1
+        self._set_valid(agents, rows, True)
+
+    def _accumulate(self, agents, rows, rewards, dones):
+        """Add the new rewards to the n-step returns of earlier rows."""
+        m = np.arange(1, self.n_step)
+        prev = (rows[:, None] - m) % self.size
+        a = np.broadcast_to(agents[:, None], prev.shape)
+        # rows of the same stream still short of n_step and not terminal
+        open_ = ((m <= self.run[agents, None])
+                 & (self.horizons[a, prev] == m) & (self.dones[a, prev] == 0))
+        a, prev = a[open_], prev[open_]
+        i = np.nonzero(open_)
+        self.rewards[a, prev] += self.discounts[m][i[1]] * rewards[i[0]]
+        self.dones[a, prev] = dones[i[0]]
+        self.horizons[a, prev] += 1
+
+    def _start_segment(self, agent, state):
+        if np.all(state == state[..., -1:]):
+            frames = [state[..., -1]]
+        else:
+            frames = [state[..., i] for i in range(self.stack)]
+        agents = np.array([agent])
+        self.run[agent] = 0
+        for i, frame in enumerate(frames):
+            self._write_frames(agents, frame[None], i == 0)
+
+    def _write_frames(self, agents, frames, starts):
+        rows = self._claim(agents)
+        self._put_frames(agents * self.size + rows, frames)
+        self._advance(agents, rows, starts)
+
+    def _claim(self, agents):
+        """Invalidate the rows the next frames of `agents` will go to."""
+        rows = self.count[agents] % self.size
+        ahead = (rows + self.stack - 1) % self.size
+        evicted = self.valid[agents, ahead]
+        if evicted.any():
+            self._reuses.append(self.uses[agents, ahead][evicted])
+        self.uses[agents, rows] = 0
+        self._set_valid(agents, rows, False)
+        # once the ring wraps, the row k-1 ahead lost its oldest stack frame
+        self._set_valid(agents, ahead, False)
+        return rows
+
+    def _advance(self, agents, rows, starts):
+        """Make the claimed rows, holding their frames now, pending."""
+        self.starts[agents, rows] = starts
+        self.count[agents] += 1
+
+    def _set_valid(self, agents, rows, flag):
+        self.valid[agents, rows] = flag
+
+    def _stack_indices(self, agents, rows):
+        k = np.arange(self.stack)
+        idx = (rows[:, None] + k - (self.stack - 1)) % self.size
+        # frames before the latest episode start repeat that start frame
+        starts = self.starts[agents[:, None], idx]
+        first = np.max(np.where(starts, k, 0), axis=1)
+        idx = idx[np.arange(len(rows))[:, None],
+                  np.maximum(k, first[:, None])]
+        return agents[:, None] * self.size + idx
+
+    def _sample_indices(self, batch_size):
+        sizes = np.minimum(self.count, self.size)
+        bounds = np.cumsum(sizes)
+        agents, rows = [], []
+        num = 0
+        while num < batch_size:
+            r = np.random.randint(bounds[-1], size=batch_size)
+            a = np.searchsorted(bounds, r, side='right')
+            row = (self.count[a] + r - bounds[a]) % self.size
+            ok = self.valid[a, row]
+            agents.append(a[ok])
+            rows.append(row[ok])
+            num += ok.sum()
+        agents = np.concatenate(agents)[:batch_size]
+        rows = np.concatenate(rows)[:batch_size]
+        # visit storage in address order, which matters for memmap files
+        order = np.argsort(agents * self.size + rows)
+        return agents[order], rows[order]
+
+
+class SumTree(object):
+    """Binary sum tree over `capacity` leaves, updated and sampled in batch."""
+
     def __init__(self, capacity):
-        self.mem = deque(maxlen=capacity)
+        self.depth = int(np.ceil(np.log2(max(capacity, 2))))
+        self.leaves = 1 << self.depth
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[indices + self.leaves]
+
+    def update(self, indices, values):
+        nodes = indices + self.leaves
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            nodes = np.unique(nodes >> 1)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Return the leaves whose prefix sums contain `values`."""
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = values.copy()
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            right = values > left
+            values -= np.where(right, left, 0)
+            nodes = 2 * nodes + right
+        return nodes - self.leaves
+
+
+class PrioritizedMemory(Memory):
+    """Proportional prioritized replay (Schaul et al., 2015).
+
+    `sample` returns `(indices, weights, batch)`; feed the per-sample errors of
+    the update back with `update_priorities(indices, errors)`. The importance
+    sampling exponent goes from `beta` to 1 with `anneal_beta`.
+    """
+
+    def __init__(self, capacity, num_agents=1, alpha=0.6, beta=0.4, eps=1e-6,
+                 **kwargs):
+        super(PrioritizedMemory, self).__init__(capacity, num_agents,
+                                                **kwargs)
+        self.alpha = alpha
+        self.beta = beta
+        self.initial_beta = beta
+        self.eps = eps
+        self.max_priority = 1.0
+        self.tree = SumTree(self.num_agents * self.size)
+
+    def sample(self, batch_size, out=None):
+        with self.lock:
+            start = time.time()
+            batch = self._sample(batch_size, self._output(batch_size, out))
+            self._sample_times.append(time.time() - start)
+        return batch
+
+    @classmethod
+    def row_bytes(cls, frame_shape=(84, 84)):
+        # the tree has up to twice as many leaves as rows, and as many nodes
+        return super(PrioritizedMemory, cls).row_bytes(frame_shape) + 32
+
+    def _arrays(self):
+        return super(PrioritizedMemory, self)._arrays() + [self.tree.tree]
+
+    def _sample(self, batch_size, out):
+        # stratified: one draw from each of `batch_size` equal mass segments
+        segments = (np.arange(batch_size) + np.random.uniform(
+            size=batch_size)) * (self.tree.total / batch_size)
+        indices = self.tree.find(segments)
+        # float round-off can land on an empty leaf, redraw those uniformly
+        empty = self.tree.get(indices) <= 0
+        if empty.any():
+            agents, rows = self._sample_indices(empty.sum())
+            indices[empty] = agents * self.size + rows
+
+        probs = self.tree.get(indices) / self.tree.total
+        weights = (len(self) * probs)**-self.beta
+        weights = (weights / weights.max()).astype(np.float32)
+        return indices, weights, self._gather(
+            *divmod(indices, self.size), out=out)
+
+    def anneal_beta(self, progress):
+        """Move beta linearly to 1 as training `progress` goes to 1."""
+        self.beta = self.initial_beta + (1.0 - self.initial_beta) * min(
+            max(progress, 0.0), 1.0)
+
+    def update_priorities(self, indices, errors):
+        priorities = np.abs(errors) + self.eps
+        with self.lock:
+            self.max_priority = max(self.max_priority, priorities.max())
+            # skip transitions overwritten since they were sampled
+            alive = self.valid.reshape(-1)[indices]
+            self.tree.update(indices[alive], priorities[alive]**self.alpha)
+
+    def _set_valid(self, agents, rows, flag):
+        super(PrioritizedMemory, self)._set_valid(agents, rows, flag)
+        priority = np.where(flag, self.max_priority**self.alpha, 0.0)
+        self.tree.update(agents * self.size + rows,
+                         np.broadcast_to(priority, rows.shape))
+
+
+class Prefetcher(object):
+    """Sample batches from a memory on a background thread.
+
+    Up to `depth` batches wait in a queue, each in its own preallocated
+    arrays. A batch returned by `get` stays valid until the next `get`.
+    """
+
+    def __init__(self, memory, batch_size, depth=2):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.ready = queue.Queue()
+        self.free = queue.Queue()
+        # one being filled, `depth` queued and one held by the learner
+        for _ in range(depth + 2):
+            self.free.put(memory.new_batch(batch_size))
+        self.current = None
+        # whether the learner holds a batch, `current` may be None for
+        # memories without preallocated batches
+        self.holding = False
+        self.stalls = []
+        self.waits = []
+        self.error = None
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    out = self.free.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                self.ready.put((out, self.memory.sample(self.batch_size,
+                                                        out)))
+        except Exception as e:
+            self.error = e
 
-    def append(self, transition):
-        self.mem.append(transition)
+    def get(self):
+        if self.holding:
+            self.free.put(self.current)
+            self.holding = False
+        self.stalls.append(self.ready.empty())
+        start = time.time()
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.current, batch = self.ready.get(timeout=0.1)
+                self.holding = True
+                break
+            except queue.Empty:
+                pass
+        self.waits.append(time.time() - start)
+        return batch
 
-    def extend(self, transitions):
-        for t in transitions:
-            self.append(t)
+    def stats(self):
+        """Share of `get` calls that found the queue empty and mean wait."""
+        if not self.waits:
+            return {}
+        s = {
+            'prefetch_stall_ratio': np.mean(self.stalls),
+            'prefetch_wait_ms': np.mean(self.waits) * 1000
+        }
+        self.stalls = []
+        self.waits = []
+        return s
 
-    def sample(self, batch_size):
-        samples = random.sample(self.mem, batch_size)
-        return map(np.array, zip(*samples))
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
@@ -0,0 +1,54 @@
+import numpy as np
+
+# Requests to a subagent are multipart messages starting with their kind:
+#   step     actions as int32, then replay rows as int64 with a shared memory
+#   reset    optionally replay rows as int64
+#   attach   msgpack (path, index, size)
+#   observe  msgpack (path, index, num_agents, half)
+#   close
+#   release  answered with b'released', the subagent goes back to its pool
+# A step is answered with a STEP record per environment and a TIMING record,
+# followed by the raw next states unless they went to a shared memory, a
+# reset with the raw states or an empty part. Finished episodes are pushed
+# separately.
+
+# per environment header of a step reply
+STEP = np.dtype([('reward', '<f4'), ('done', '?')])
+# seconds a subagent spent on a step: stepping its envs, of which emulating
+# and preprocessing summed over envs, and serializing its previous reply
+TIMING = np.dtype([('step', '<f4'), ('emulate', '<f4'), ('preprocess', '<f4'),
+                   ('serialize', '<f4')])
+
+
+def pack_step(rewards, dones):
+    header = np.empty(len(rewards), dtype=STEP)
+    header['reward'] = rewards
+    header['done'] = dones
+    return header
+
+
+def unpack_step(buffer):
+    """Rewards and dones of a step header, without copying."""
+    header = np.frombuffer(buffer, dtype=STEP)
+    return header['reward'], header['done']
+
+
+def pack_timing(step, emulate, preprocess, serialize):
+    return np.array([(step, emulate, preprocess, serialize)], dtype=TIMING)
+
+
+def unpack_timing(buffer):
+    return np.frombuffer(buffer, dtype=TIMING)[0]
+
+
+def unpack_states(buffer, dtype, shape):
+    """Batch of raw states, a read-only view of `buffer`."""
+    return np.frombuffer(buffer, dtype=dtype).reshape((-1, ) + tuple(shape))
+
+
+def pack_indices(x, dtype=np.int64):
+    return np.ascontiguousarray(x, dtype=dtype)
+
+
+def unpack_indices(buffer, dtype=np.int64):
+    return np.frombuffer(buffer, dtype=dtype)
@@ -0,0 +1,188 @@
+import os
+import zmq
+import time
+import click
+import msgpack
+import threading
+import numpy as np
+import msgpack_numpy
+from memory import Memory, PrioritizedMemory, quantize
+
+msgpack_numpy.patch()
+
+
+def insert_url(url):
+    """The PULL endpoint paired with a replay server's request `url`."""
+    if url.startswith('tcp://'):
+        host, port = url.rsplit(':', 1)
+        return '{}:{}'.format(host, int(port) + 1)
+    return url + '-insert'
+
+
+class ReplayServer(object):
+    """Serve a memory to learners and subagents over ZMQ.
+
+    Inserts and priority updates arrive fire-and-forget on a PULL socket,
+    samples are requested on a ROUTER socket. Both work over ipc:// and
+    tcp:// alike.
+    """
+
+    def __init__(self, memory, url):
+        self.memory = memory
+        if url.startswith('ipc://'):
+            path = os.path.dirname(url[len('ipc://'):])
+            if path and not os.path.exists(path):
+                os.makedirs(path)
+        self.context = zmq.Context()
+        self.router = self.context.socket(zmq.ROUTER)
+        self.router.bind(url)
+        self.pull = self.context.socket(zmq.PULL)
+        self.pull.bind(insert_url(url))
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.router, zmq.POLLIN)
+        poller.register(self.pull, zmq.POLLIN)
+        print('replay server start!')
+        while True:
+            events = dict(poller.poll())
+            if self.pull in events:
+                self._drain()
+            if self.router in events:
+                addr, empty, msg = self.router.recv_multipart()
+                msg = msgpack.loads(msg)
+                if msg[0] == b'close':
+                    self.router.send_multipart(
+                        [addr, b'', msgpack.dumps(b'closed')])
+                    break
+                # serve inserts that raced ahead of this request first
+                self._drain()
+                self.router.send_multipart(
+                    [addr, b'', msgpack.dumps(self._request(msg))])
+        self.router.close()
+        self.pull.close()
+        self.context.term()
+
+    def _drain(self):
+        while True:
+            try:
+                msg = msgpack.loads(self.pull.recv(zmq.NOBLOCK))
+            except zmq.Again:
+                return
+            if msg[0] == b'extend':
+                self.memory.extend(tuple(msg[1:6]), msg[6])
+            elif msg[0] == b'append':
+                self.memory.append(msg[1], agent=msg[2])
+            elif msg[0] == b'update_priorities':
+                self.memory.update_priorities(msg[1], msg[2])
+            elif msg[0] == b'anneal_beta':
+                self.memory.anneal_beta(msg[1])
+
+    def _request(self, msg):
+        if msg[0] == b'info':
+            return (self.memory.num_agents,
+                    isinstance(self.memory, PrioritizedMemory))
+        if msg[0] == b'sample':
+            if len(self.memory) == 0:
+                return b'empty'
+            return self.memory.sample(msg[1])
+        if msg[0] == b'len':
+            return len(self.memory)
+        if msg[0] == b'stats':
+            return self.memory.stats()
+        raise Exception('{} is not supported!'.format(msg[0]))
+
+
+class RemoteMemory(object):
+    """Client side of a ReplayServer with the interface dqn() uses.
+
+    `sample` may run on a Prefetcher thread while the learner inserts, since
+    inserts go through a separate PUSH socket, and the requests of both
+    threads share the REQ socket under a lock.
+    """
+
+    def __init__(self, url):
+        self.context = zmq.Context()
+        self.request = self.context.socket(zmq.REQ)
+        self.request.connect(url)
+        self.push = self.context.socket(zmq.PUSH)
+        self.push.connect(insert_url(url))
+        # zmq sockets are not thread safe
+        self.lock = threading.Lock()
+        self.num_agents, self.prioritized = self._call(b'info')
+
+    def _call(self, *msg):
+        with self.lock:
+            self.request.send(msgpack.dumps(msg))
+            return msgpack.loads(self.request.recv())
+
+    def __len__(self):
+        return self._call(b'len')
+
+    def append(self, transition, agent=0):
+        self.push.send(msgpack.dumps((b'append', transition, agent)))
+
+    def extend(self, transitions, agents=None):
+        # frames travel as uint8, a quarter of the float32 bytes
+        states, actions, rewards, next_states, dones = transitions
+        self.push.send(
+            msgpack.dumps((b'extend', quantize(states), actions, rewards,
+                           quantize(next_states), dones, agents)))
+
+    def update_priorities(self, indices, errors):
+        self.push.send(
+            msgpack.dumps((b'update_priorities', indices, errors)))
+
+    def anneal_beta(self, progress):
+        self.push.send(msgpack.dumps((b'anneal_beta', progress)))
+
+    def stats(self):
+        # older msgpack hands back str keys as bytes
+        return {
+            key.decode() if isinstance(key, bytes) else key: value
+            for key, value in self._call(b'stats').items()
+        }
+
+    def new_batch(self, batch_size):
+        return None
+
+    def sample(self, batch_size, out=None):
+        while True:
+            batch = self._call(b'sample', batch_size)
+            if batch != b'empty':
+                break
+            time.sleep(0.01)
+        if self.prioritized:
+            return batch[0], batch[1], tuple(batch[2])
+        return tuple(batch)
+
+    def close(self):
+        self.request.close()
+        self.push.close()
+        self.context.term()
+
+
+@click.command()
+@click.option('--url', default='ipc://./.ipc/replay.ipc')
+@click.option('--memory_size', type=int, default=100000)
+@click.option('--num_agents', type=int, default=32)
+@click.option('--prioritized', is_flag=True)
+@click.option('--n_step', type=int, default=1)
+@click.option('--discount', type=float, default=0.99)
+@click.option('--compress', is_flag=True)
+@click.option('--uint8_obs', is_flag=True)
+def main(url, memory_size, num_agents, prioritized, n_step, discount,
+         compress, uint8_obs):
+    memory_class = PrioritizedMemory if prioritized else Memory
+    memory = memory_class(
+        memory_size,
+        num_agents,
+        n_step=n_step,
+        discount=discount,
+        compress=compress,
+        state_dtype=np.uint8 if uint8_obs else np.float32)
+    ReplayServer(memory, url).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,19 @@
+import os
+import sys
 import zmq
 import time
 import click
+import select
+import traceback
 import msgpack
 import numpy as np
 import msgpack_numpy
-from wrapper import atari_env
+from memory import quantize
+from wrapper import atari_env, new_game
+from affinity import parse_cpus, pin
+from protocol import pack_step, pack_timing, unpack_indices
+from replay_server import insert_url
+from concurrent.futures import ThreadPoolExecutor
 msgpack_numpy.patch()
 
 
@@ -34,66 +43,371 @@ class GameInfo(object):
 
 
 class SubAgent(object):
-    def __init__(self, game_name, identity, url):
-        self.env = atari_env(game_name)
+    """Host `num_envs` environments and step them as one batch.
+
+    The environments are stepped on a thread pool of `num_threads`, one per
+    env by default, ALE and cv2 release the GIL, and every request is
+    answered with one batched message.
+
+    With `hot_spares` every env has a spare whose next game is reset in the
+    background. A game over then swaps in the spare instead of waiting for
+    the ALE reset, noops and fire steps, and the finished env is reset as
+    the next spare.
+    """
+
+    def __init__(self,
+                 game_name,
+                 identity,
+                 url,
+                 replay_url=None,
+                 uint8_obs=False,
+                 num_envs=1,
+                 single_frame=False,
+                 hot_spares=False,
+                 num_threads=None):
+        # with `single_frame` the learner stacks the frames itself
+        stack = 1 if single_frame else 4
+        self.envs = [
+            atari_env(game_name, stack=stack, uint8=uint8_obs)
+            for _ in range(num_envs)
+        ]
+        self.num_envs = num_envs
+        self.lease(identity, url, replay_url)
+        if num_threads is None:
+            num_threads = num_envs
+        self.pool = None
+        if num_threads > 1:
+            self.pool = ThreadPoolExecutor(num_threads)
+        # futures of (env, start state) ready for the next game of each env
+        self.spares = None
+        if hot_spares:
+            # one thread, game overs are rare next to steps
+            self.spare_pool = ThreadPoolExecutor(1)
+            self.spares = [
+                self.spare_pool.submit(
+                    self._prepare_spare, j,
+                    atari_env(game_name, stack=stack, uint8=uint8_obs))
+                for j in range(num_envs)
+            ]
+
+        env = self.envs[0]
+        self.action_n = env.action_space.n
+        self.allowed_actions = list(range(self.action_n))
+        self.release()
+
+    def lease(self, identity, url, replay_url=None):
+        """Serve the learner at `url` as subagent `identity`."""
+        # agent index of the first environment
+        self.index = int(identity) * self.num_envs
         self.identity = 'SubAgent-{}'.format(identity)
         self.url = url
+        self.replay_url = replay_url
 
-        self.action_n = self.env.action_space.n
-        self.allowed_actions = list(range(self.action_n))
+    def release(self):
+        """Forget a learner's games and shared memory, keep the envs."""
+        for env in self.envs:
+            new_game(env)
+        self.game_infos = [GameInfo() for _ in range(self.num_envs)]
+        self.states = [None] * self.num_envs
+        # rows of the learner's shared replay frames owned by this subagent
+        self.frames = None
+        # slots of the learner's shared observation batch, in two halves
+        self.obs = None
+        self.half = 0
+        # seconds of the last step, see protocol.TIMING
+        self.step_timing = (0.0, 0.0, 0.0)
+        self.serialize_time = 0.0
 
     def run(self):
+        """Serve requests until closed, True if released instead."""
         context = zmq.Context()
         socket = context.socket(zmq.REQ)
         socket.identity = self.identity.encode('utf-8')
         socket.connect(self.url)
+        # finished episodes, at a low rate next to the step replies
+        episode_socket = context.socket(zmq.PUSH)
+        episode_socket.connect(insert_url(self.url))
+        replay_socket = None
+        if self.replay_url is not None:
+            replay_socket = context.socket(zmq.PUSH)
+            replay_socket.connect(insert_url(self.replay_url))
 
         # Reset env
         print('subagent {} start!'.format(self.identity))
+        space = self.envs[0].observation_space
+        # the learner checks these against its own flags
         socket.send(
-            msgpack.dumps((b'ready', self.action_n,
-                           self.env.observation_space.shape)))
+            msgpack.dumps((b'ready', self.action_n, space.shape,
+                           np.dtype(space.dtype).name, self.num_envs)))
 
         while True:
-            action = socket.recv()
-            if action == b'reset':
-                self.seed()
-                state = self.env.reset()
-                game_info = GameInfo()
-                socket.send(msgpack.dumps(state))
+            request = socket.recv_multipart()
+            kind = request[0]
+            if kind == b'reset':
+                states = self.reset()
+                if len(request) > 1:
+                    self.write_frames(unpack_indices(request[1]), states)
+                    socket.send(b'')
+                elif self.obs is not None:
+                    self.write_obs(states)
+                    socket.send(b'')
+                else:
+                    socket.send(states, copy=False)
+                continue
+
+            if kind == b'attach':
+                self.attach(*msgpack.loads(request[1]))
+                socket.send(b'attached')
+                continue
+
+            if kind == b'observe':
+                self.observe(*msgpack.loads(request[1]))
+                socket.send(b'observed')
                 continue
 
-            if action == b'close':
+            if kind in (b'close', b'release'):
+                episode_socket.close()
+                if replay_socket is not None:
+                    replay_socket.close()
+                if kind == b'close':
+                    self.close()
+                else:
+                    # the environments stay up for the next lease
+                    self.release()
+                    socket.send(b'released')
                 socket.close()
                 context.term()
-                break
-
-            action = msgpack.loads(action)
-            assert action in self.allowed_actions
-            next_state, reward, done, origin_info = self.env.step(action)
-            game_info.update(reward)
-            info = {}
-            if done:
-                info = game_info.get(origin_info)
+                return kind == b'release'
+
+            assert kind == b'step'
+            actions = unpack_indices(request[1], np.int32)
+            next_states, rewards, dones, infos = self.step(actions)
+            stepped = time.time()
+            if replay_socket is not None:
+                for j in range(self.num_envs):
+                    replay_socket.send(
+                        msgpack.dumps(
+                            (b'append',
+                             (quantize(self.states[j]), actions[j],
+                              rewards[j], quantize(next_states[j]),
+                              dones[j]), self.index + j)))
+            self.states = list(next_states)
+            for j, info in enumerate(infos):
+                if info:
+                    episode_socket.send(msgpack.dumps((self.index + j, info)))
+
+            # the serialization of a reply goes with the next one
+            reply = [
+                pack_step(rewards, dones),
+                pack_timing(*(self.step_timing + (self.serialize_time, )))
+            ]
+            if len(request) > 2:
+                # shared replay rows
+                self.write_frames(unpack_indices(request[2]), next_states)
+            elif self.obs is not None:
+                self.write_obs(next_states)
+            else:
+                reply.append(next_states)
+            socket.send_multipart(reply, copy=False)
+            self.serialize_time = time.time() - stepped
+
+    def _map(self, fn, *args):
+        if self.pool is None:
+            return list(map(fn, *args))
+        return list(self.pool.map(fn, *args))
+
+    def reset(self):
+        self.states = self._map(self._reset, range(self.num_envs))
+        return np.array(self.states)
+
+    def _reset(self, j):
+        self.seed(j)
+        self.game_infos[j] = GameInfo()
+        # not the next life of a game played before
+        new_game(self.envs[j])
+        return self.envs[j].reset()
+
+    def step(self, actions, out=None):
+        """Step every environment, resetting those that are done.
+
+        Next states, rewards and dones are written to the `out` arrays if
+        given.
+        """
+        start = time.time()
+        results = self._map(self._step, range(self.num_envs), actions)
+        next_states, rewards, dones, infos, timings = zip(*results)
+        emulate, preprocess = np.sum(timings, axis=0)
+        self.step_timing = (time.time() - start, emulate, preprocess)
+        if out is None:
+            return (np.array(next_states), np.sign(rewards), np.array(dones),
+                    list(infos))
+        state_batch, reward_batch, done_batch = out
+        np.stack(next_states, out=state_batch)
+        np.sign(rewards, out=reward_batch)
+        done_batch[:] = dones
+        return state_batch, reward_batch, done_batch, list(infos)
+
+    def _step(self, j, action):
+        assert action in self.allowed_actions
+        env = self.envs[j]
+        next_state, reward, done, origin_info = env.step(action)
+        timings = env.timings
+        game_info = self.game_infos[j]
+        game_info.update(reward)
+        info = {}
+        if done:
+            info = game_info.get(origin_info)
+            if origin_info['was_real_done'] and self.spares is not None:
+                next_state = self._swap_spare(j)
+            else:
                 if origin_info['was_real_done']:
-                    self.seed()
-                next_state = self.env.reset()
+                    self.seed(j)
+                # a lost life is a single noop step
+                next_state = env.reset()
+        return next_state, reward, done, info, timings
+
+    def _swap_spare(self, j):
+        """Start the next game of env `j` on its spare."""
+        finished = self.envs[j]
+        self.envs[j], state = self.spares[j].result()
+        self.spares[j] = self.spare_pool.submit(self._prepare_spare, j,
+                                                finished)
+        return state
+
+    def _prepare_spare(self, j, env):
+        self.seed(j, env)
+        return env, env.reset()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.spares is not None:
+            self.spare_pool.shutdown()
+            for spare in self.spares:
+                spare.result()[0].close()
+        for env in self.envs:
+            env.close()
+
+    def attach(self, path, index, size):
+        shape = self.envs[0].observation_space.shape[:2]
+        self.frames = np.memmap(
+            os.path.join(path.decode('utf-8'), 'frames.bin'),
+            dtype=np.uint8,
+            mode='r+',
+            offset=index * size * shape[0] * shape[1],
+            shape=(self.num_envs, size) + shape)
+
+    def write_frames(self, rows, states):
+        self.frames[np.arange(self.num_envs), rows] = quantize(
+            states[..., -1])
+
+    def observe(self, path, index, num_agents, half=0):
+        space = self.envs[0].observation_space
+        obs = np.memmap(
+            path.decode('utf-8'),
+            dtype=space.dtype,
+            mode='r+',
+            shape=(2, num_agents) + space.shape)
+        self.obs = obs[:, index:index + self.num_envs]
+        # a respawned subagent resumes at the learner's half
+        self.half = half
+
+    def write_obs(self, states):
+        # the learner flips to the same half on every reset and step
+        self.half ^= 1
+        self.obs[self.half] = states
+
+    def seed(self, j, env=None):
+        # environments reset in the same millisecond still differ
+        seed = (int(time.time() * 1000) + self.index + j) % 2147483647
+        if env is None:
+            env = self.envs[j]
+        env.unwrapped.ale.setInt(b'random_seed', seed)
+
+
+def serve_template(*args):
+    """Fork a subagent for every identity read from stdin.
+
+    Runs with gym, cv2 and the rest of this module imported once, so each
+    worker starts with a fork instead of a fresh interpreter. `args` are
+    those of `SubAgent` but the identity, the pid of every worker is
+    written to stdout. An identity may be followed by the CPUs to pin its
+    worker to. Workers that exit are reaped and reported on stdout as
+    `exit <pid> <status>`, with the status of `os.waitpid`.
+    """
+    out = os.fdopen(os.dup(1), 'w')
+    # workers print to stderr, stdout carries the pids
+    os.dup2(2, 1)
+    stdin = sys.stdin.fileno()
+    pending = b''
+    while True:
+        readable = select.select([stdin], [], [], 0.1)[0]
+        _reap(out)
+        if not readable:
+            continue
+        data = os.read(stdin, 4096)
+        if not data:
+            break
+        pending += data
+        while b'\n' in pending:
+            line, pending = pending.split(b'\n', 1)
+            out.write('{}\n'.format(_fork_worker(args, line.decode(), out)))
+            out.flush()
+
+
+def _reap(out):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            # no children
+            return
+        if pid == 0:
+            return
+        out.write('exit {} {}\n'.format(pid, status))
+        out.flush()
 
-            socket.send(
-                msgpack.dumps((next_state, np.sign(reward), done, info)))
 
-    def seed(self):
-        self.env.unwrapped.ale.setInt(b'random_seed',
-                                      int(time.time() * 1000) % 2147483647)
+def _fork_worker(args, line, out):
+    pid = os.fork()
+    if pid == 0:
+        out.close()
+        # forked workers would otherwise share the random state
+        np.random.seed()
+        fields = line.split()
+        try:
+            if len(fields) > 1:
+                # before the env threads start, they inherit the mask
+                pin(parse_cpus(fields[1]))
+            SubAgent(args[0], fields[0], *args[1:]).run()
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    return pid
 
 
 @click.command()
 @click.option('--game_name')
 @click.option('--identity')
 @click.option('--basename')
-def main(game_name, identity, basename):
-    s = SubAgent(game_name, identity,
-                 'ipc://./.ipc/{}/Agent.ipc'.format(basename))
+@click.option('--url', default=None)
+@click.option('--replay_url', default=None)
+@click.option('--uint8_obs', is_flag=True)
+@click.option('--num_envs', type=int, default=1)
+@click.option('--single_frame', is_flag=True)
+@click.option('--hot_spares', is_flag=True)
+@click.option('--template', is_flag=True)
+def main(game_name, identity, basename, url, replay_url, uint8_obs, num_envs,
+         single_frame, hot_spares, template):
+    if url is None:
+        url = 'ipc://./.ipc/{}/Agent.ipc'.format(basename)
+    if template:
+        serve_template(game_name, url, replay_url, uint8_obs, num_envs,
+                       single_frame, hot_spares)
+        return
+    s = SubAgent(game_name, identity, url, replay_url, uint8_obs, num_envs,
+                 single_frame, hot_spares)
     s.run()
 
 
@@ -3,7 +3,10 @@ import click
 import traceback
 from dqn import dqn
 from agent import Agent
-from estimator import get_estimator
+from localagent import LocalAgent
+from memory import Memory, PrioritizedMemory
+from affinity import check_cpus, layout, parse_cpus, pin, single_node
+from estimator import get_estimator, GraphMemory, PrioritizedGraphMemory
 from util import train_path
 
 
@@ -14,7 +17,42 @@ from util import train_path
 @click.option('--update_target_every', type=int, default=1000)
 @click.option('--model_name', default='dqn')
 @click.option('--tau', type=float, default=0.001)
-def main(game_name, lr, num_agents, update_target_every, model_name, tau):
+@click.option('--memory_size', type=int, default=100000)
+@click.option('--replay_gb', type=float, default=None)
+@click.option('--prioritized', is_flag=True)
+@click.option('--replay_on_disk', is_flag=True)
+@click.option('--snapshot_replay', is_flag=True)
+@click.option('--n_step', type=int, default=1)
+@click.option('--prefetch_depth', type=int, default=0)
+@click.option('--shared_replay', is_flag=True)
+@click.option('--compress_replay', is_flag=True)
+@click.option('--replay_url', default=None)
+@click.option('--workers_insert', is_flag=True)
+@click.option('--graph_replay', is_flag=True)
+@click.option('--shared_obs', is_flag=True)
+@click.option('--uint8_obs', is_flag=True)
+@click.option('--envs_per_worker', type=int, default=1)
+@click.option('--async_groups', type=int, default=0)
+@click.option('--partial_agents', type=int, default=None)
+@click.option('--step_timeout_ms', type=float, default=None)
+@click.option('--stack_on_learner', is_flag=True)
+@click.option('--learner_cpus', default=None)
+@click.option('--worker_cpus', default=None)
+@click.option('--tf_intra_threads', type=int, default=0)
+@click.option('--tf_inter_threads', type=int, default=0)
+@click.option('--agent_url', default=None)
+@click.option('--local_workers', type=int, default=None)
+@click.option('--in_process', is_flag=True)
+@click.option('--hot_spares', is_flag=True)
+@click.option('--pool_url', default=None)
+def main(game_name, lr, num_agents, update_target_every, model_name, tau,
+         memory_size, replay_gb, prioritized, replay_on_disk, snapshot_replay,
+         n_step, prefetch_depth, shared_replay, compress_replay, replay_url,
+         workers_insert, graph_replay, shared_obs, uint8_obs,
+         envs_per_worker, async_groups, partial_agents, step_timeout_ms,
+         stack_on_learner, learner_cpus, worker_cpus, tf_intra_threads,
+         tf_inter_threads, agent_url, local_workers, in_process, hot_spares,
+         pool_url):
     assert 'NoFrameskip-v4' in game_name
 
     if 'soft' in model_name:
@@ -26,9 +64,82 @@ def main(game_name, lr, num_agents, update_target_every, model_name, tau):
     if 'soft' in model_name:
         basename += ':tau={}'.format(tau)
 
-    env = Agent(num_agents, game_name, basename)
+    if prioritized:
+        basename += ':per'
+
+    if n_step > 1:
+        basename += ':n={}'.format(n_step)
+
+    step_timeout = None
+    if step_timeout_ms is not None:
+        step_timeout = step_timeout_ms / 1000.0
+
+    if replay_gb is not None:
+        memory_class = PrioritizedMemory if prioritized else Memory
+        memory_size = int(replay_gb * 2**30) // memory_class.row_bytes()
+        print('replay memory of {} GB holds {} transitions.'.format(
+            replay_gb, memory_size))
+
+    if learner_cpus is not None:
+        learner_cpus = parse_cpus(learner_cpus)
+        check_cpus(learner_cpus, '--learner_cpus')
+    if worker_cpus is not None:
+        worker_cpus = parse_cpus(worker_cpus)
+        check_cpus(worker_cpus, '--worker_cpus')
+    tf_threads = (tf_intra_threads, tf_inter_threads)
+
+    # the subagents' transitions go to the replay server only
+    assert replay_url is not None or not workers_insert, (
+        '--workers_insert needs a --replay_url')
+
+    if in_process:
+        # the environments step in this process, synchronously
+        assert not (shared_replay or shared_obs or workers_insert
+                    or stack_on_learner or async_groups or partial_agents
+                    or step_timeout_ms is not None or worker_cpus
+                    or agent_url or pool_url or local_workers is not None
+                    or envs_per_worker != 1), (
+                        'option not supported with --in_process')
+        env = LocalAgent(
+            num_agents, game_name, uint8_obs=uint8_obs, hot_spares=hot_spares)
+    else:
+        env = Agent(
+            num_agents,
+            game_name,
+            basename,
+            replay_url if workers_insert else None,
+            shared_obs=shared_obs,
+            uint8_obs=uint8_obs,
+            envs_per_worker=envs_per_worker,
+            stack_on_learner=stack_on_learner,
+            worker_cpus=worker_cpus,
+            url=agent_url,
+            local_workers=local_workers,
+            hot_spares=hot_spares,
+            pool_url=pool_url)
     try:
-        estimator = get_estimator(model_name, env.action_n, lr, 0.99, tau=tau)
+        if learner_cpus is not None:
+            # after the subagents' template is forked, which would inherit
+            # the mask, and before TF's thread pools start
+            pin(learner_cpus)
+        for line in layout(learner_cpus, None if in_process else
+                           env.worker_cpus, tf_threads):
+            print(line)
+        memory = None
+        if graph_replay:
+            memory_class = (PrioritizedGraphMemory
+                            if prioritized else GraphMemory)
+            memory = memory_class(
+                memory_size, num_agents, n_step=n_step, discount=0.99)
+        estimator = get_estimator(
+            model_name,
+            env.action_n,
+            lr,
+            0.99,
+            memory=memory,
+            uint8_obs=uint8_obs,
+            tf_threads=tf_threads,
+            tau=tau)
         base_path = os.path.join(train_path, basename)
         print("start training!!")
         dqn(env,
@@ -39,8 +150,21 @@ def main(game_name, lr, num_agents, update_target_every, model_name, tau):
             save_model_every=1000,
             update_target_every=update_target_every,
             learning_starts=200,
-            memory_size=100000,
-            num_iterations=40000000)
+            memory_size=memory_size,
+            num_iterations=40000000,
+            prioritized=prioritized,
+            replay_on_disk=replay_on_disk,
+            snapshot_replay=snapshot_replay,
+            n_step=n_step,
+            prefetch_depth=prefetch_depth,
+            shared_replay=shared_replay,
+            compress_replay=compress_replay,
+            replay_url=replay_url,
+            workers_insert=workers_insert,
+            async_groups=async_groups,
+            partial_agents=partial_agents,
+            step_timeout=step_timeout,
+            prefault_replay=single_node(learner_cpus) is not None)
     except KeyboardInterrupt:
         print("\nKeyboard interrupt!!")
     except Exception:
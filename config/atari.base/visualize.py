@@ -5,6 +5,7 @@ import imageio
 import numpy as np
 from tqdm import tqdm
 
+from agent import Agent
 from wrapper import atari_env
 from estimator import get_estimator
 train_path = './train_log'
@@ -13,11 +14,19 @@ train_path = './train_log'
 @click.option('--game_name')
 @click.option('--model_name', default='dqn')
 @click.option('--write_video', is_flag=True)
-def main(game_name, model_name, write_video):
+@click.option('--pool_url', default=None)
+def main(game_name, model_name, write_video, pool_url):
     assert 'NoFrameskip-v4' in game_name
-    env = atari_env(game_name)
+    num_eval = 10
+    if pool_url is None or write_video:
+        env = atari_env(game_name)
+        action_n = env.action_space.n
+    else:
+        # the evaluation episodes run at once on workers of the pool
+        env = Agent(num_eval, game_name, 'evaluate', pool_url=pool_url)
+        action_n = env.action_n
 
-    estimator = get_estimator(model_name, env.action_space.n, 0.001, 0.99)
+    estimator = get_estimator(model_name, action_n, 0.001, 0.99)
 
     basename_list = [
         name for name in os.listdir(train_path) if (game_name[:-14] in name) and (model_name in name)
@@ -75,6 +84,22 @@ def main(game_name, model_name, write_video):
                         state = env.reset()
         print('mean: {}, max: {}'.format(sum(res) / num_eval, max(res)))
 
+    def evaluate_leased(basename):
+        checkpoint_path = os.path.join(train_path, basename, 'models')
+        estimator.load_model(checkpoint_path)
+
+        # the first full game of every agent, from a new game each
+        res = {}
+        states = env.reset()
+        while len(res) < num_eval:
+            actions = estimator.get_action(states, 0.0)
+            states, rewards, dones, info = env.step(actions)
+            for j, msg in info.items():
+                if b'real_reward' in msg and j not in res:
+                    res[j] = msg[b'real_reward']
+        res = list(res.values())
+        print('mean: {}, max: {}'.format(sum(res) / num_eval, max(res)))
+
     if write_video:
         for basename in basename_list:
             print("Writing {}'s video ...".format(basename))
@@ -82,7 +107,12 @@ def main(game_name, model_name, write_video):
     else:
         for basename in basename_list:
             print("Evaluating {} ...".format(basename))
-            evaluate(basename)
+            if pool_url is None:
+                evaluate(basename, num_eval)
+            else:
+                evaluate_leased(basename)
+        if pool_url is not None:
+            env.close()
 
 
 if __name__ == '__main__':
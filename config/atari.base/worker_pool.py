@@ -0,0 +1,158 @@
+import os
+import zmq
+import click
+import signal
+import traceback
+import msgpack
+import numpy as np
+from collections import deque
+from affinity import pin_threads
+from subagent import SubAgent
+
+
+def _str(x):
+    # older msgpack hands back str as bytes
+    return x.decode('utf-8') if isinstance(x, bytes) else x
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def worker_key(game_name, uint8_obs=False, num_envs=1, single_frame=False,
+               hot_spares=False):
+    """The `SubAgent` arguments a pooled worker is built with."""
+    return (_str(game_name), bool(uint8_obs), int(num_envs),
+            bool(single_frame), bool(hot_spares))
+
+
+class WorkerPool(object):
+    """Keep subagents and their environments alive between jobs.
+
+    Learners lease workers with `(b'lease', key, url, identity, replay_url,
+    cpus)` and get back the pid of a worker that connects to `url` as
+    subagent `identity`, see `Agent(pool_url=...)`. An idle worker built
+    with the same `worker_key` is reused, otherwise one is forked from
+    this process, which has gym, cv2 and the subagent imported already.
+    Once the learner sends it `release` the worker comes back here and
+    waits for its next lease, up to `max_idle` of them per key.
+    """
+
+    def __init__(self, url, max_idle=64):
+        if url.startswith('ipc://'):
+            path = os.path.dirname(url[len('ipc://'):])
+            if path and not os.path.exists(path):
+                os.makedirs(path)
+        self.url = url
+        self.max_idle = max_idle
+        self.context = zmq.Context()
+        self.router = self.context.socket(zmq.ROUTER)
+        self.router.bind(url)
+        # (address, pid) of the workers waiting for a lease, by key
+        self.idle = {}
+
+    def run(self):
+        # exited workers are reaped by the kernel
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        print('worker pool start!')
+        while True:
+            addr, empty, msg = self.router.recv_multipart()
+            msg = msgpack.loads(msg)
+            if msg[0] == b'idle':
+                # answered with its next lease
+                idle = self.idle.setdefault(worker_key(*msg[2]), deque())
+                if len(idle) < self.max_idle:
+                    idle.append((addr, msg[1]))
+                else:
+                    self._send(addr, None)
+            elif msg[0] == b'lease':
+                self._send(addr, self.lease(worker_key(*msg[1]), msg[2:]))
+            elif msg[0] == b'stats':
+                self._send(addr, {
+                    ':'.join(str(k) for k in key): len(idle)
+                    for key, idle in self.idle.items()
+                })
+            elif msg[0] == b'close':
+                self._send(addr, b'closed')
+                break
+            else:
+                raise Exception('{} is not supported!'.format(msg[0]))
+        # idle workers exit, leased ones once released
+        for idle in self.idle.values():
+            for addr, pid in idle:
+                self._send(addr, None)
+        self.router.close()
+        self.context.term()
+
+    def _send(self, addr, msg):
+        self.router.send_multipart([addr, b'', msgpack.dumps(msg)])
+
+    def lease(self, key, lease):
+        """Pid of the worker given `lease`, an idle one if there is any."""
+        idle = self.idle.get(key, ())
+        while idle:
+            addr, pid = idle.popleft()
+            if _alive(pid):
+                self._send(addr, lease)
+                return pid
+        pid = os.fork()
+        if pid == 0:
+            # the child leaves this process' zmq context alone
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # forked workers would otherwise share the random state
+            np.random.seed()
+            try:
+                work(self.url, key, lease)
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0)
+        return pid
+
+
+def work(pool_url, key, lease):
+    """Serve leases of the pool at `pool_url` until it lets us go."""
+    context = zmq.Context()
+    pool = context.socket(zmq.REQ)
+    pool.connect(pool_url)
+    parent = os.getppid()
+    agent = None
+    while lease is not None:
+        url, identity, replay_url, cpus = [_str(x) for x in lease]
+        if cpus is not None:
+            # the env threads of a reused worker are running already
+            pin_threads(cpus)
+        if agent is None:
+            agent = SubAgent(key[0], identity, url, replay_url, *key[1:])
+        else:
+            agent.lease(identity, url, replay_url)
+        if not agent.run():
+            agent = None
+            break
+        pool.send(msgpack.dumps((b'idle', os.getpid(), key)))
+        # a pool that exited does not answer
+        while not pool.poll(1000):
+            if os.getppid() != parent:
+                lease = None
+                break
+        else:
+            lease = msgpack.loads(pool.recv())
+    if agent is not None:
+        agent.close()
+    pool.close(linger=0)
+    context.term()
+
+
+@click.command()
+@click.option('--url', default='ipc://./.ipc/workers.ipc')
+@click.option('--max_idle', type=int, default=64)
+def main(url, max_idle):
+    WorkerPool(url, max_idle).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,13 @@
 import cv2
 import gym
+import time
 import random
 import numpy as np
 from collections import deque
 from gym.spaces.box import Box
 
 
-def atari_env(env_id, skip=4, stack=4):
+def atari_env(env_id, skip=4, stack=4, uint8=False):
     env = gym.make(env_id)
     if 'NoFrameskip' in env_id:
         assert 'NoFrameskip' in env.spec.id
@@ -16,11 +17,19 @@ def atari_env(env_id, skip=4, stack=4):
     env = EpisodicLifeEnv(env)
     if 'FIRE' in env.unwrapped.get_action_meanings():
         env = FireResetEnv(env)
-    env = FrameWarpAndStack(env, stack)
+    env = FrameWarpAndStack(env, stack, uint8=uint8)
     # env = NormalizedEnv(env)
     return env
 
 
+def new_game(env):
+    """Make the next `reset` of `env` start a new game, not the next life."""
+    while isinstance(env, gym.Wrapper):
+        if isinstance(env, EpisodicLifeEnv):
+            env.was_real_done = True
+        env = env.env
+
+
 class VisualizeEnv(gym.Wrapper):
     def __init__(self, env):
         gym.Wrapper.__init__(self, env)
@@ -176,21 +185,28 @@ class MaxAndSkipEnv(gym.Wrapper):
 
 
 class FrameWarpAndStack(gym.Wrapper):
-    def __init__(self, env, k, data_format='channels_last'):
-        """Stack k last frames."""
+    def __init__(self, env, k, data_format='channels_last', uint8=False):
+        """Stack k last frames, as raw uint8 pixels if `uint8`."""
         gym.Wrapper.__init__(self, env)
         self.k = k
+        self.uint8 = uint8
         self.width = 84
         self.height = 84
         self.frames = deque([], maxlen=k)
+        # seconds the last step spent in the wrapped env and preprocessing
+        self.timings = (0.0, 0.0)
 
         self.data_format = data_format
         if data_format == 'channels_last':
             shp = (self.width, self.height, k)
         elif data_format == 'channels_first':
             shp = (k, self.width, self.height)
-        self.observation_space = Box(
-            low=0.0, high=1.0, shape=shp, dtype=np.float32)
+        if uint8:
+            self.observation_space = Box(
+                low=0, high=255, shape=shp, dtype=np.uint8)
+        else:
+            self.observation_space = Box(
+                low=0.0, high=1.0, shape=shp, dtype=np.float32)
 
     def reset(self, **kwargs):
         ob = self.env.reset(**kwargs)
@@ -199,20 +215,25 @@ class FrameWarpAndStack(gym.Wrapper):
         return self._get_ob()
 
     def step(self, action):
+        start = time.time()
         ob, reward, done, info = self.env.step(action)
+        stepped = time.time()
         self.frames.append(self._preprocess(ob))
-        return self._get_ob(), reward, done, info
+        ob = self._get_ob()
+        self.timings = (stepped - start, time.time() - stepped)
+        return ob, reward, done, info
 
     def _get_ob(self):
         assert len(self.frames) == self.k
         if self.data_format == 'channels_last':
-            return np.stack(self.frames, axis=2).astype(np.float32)
+            return np.stack(self.frames, axis=2)
         elif self.data_format == 'channels_first':
-            return np.array(self.frams).astype(np.float32)
+            return np.array(self.frames)
 
     def _preprocess(self, frame):
         frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
         frame = cv2.resize(
             frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
-        frame = frame.astype(np.float32) / 255.0
+        if not self.uint8:
+            frame = frame.astype(np.float32) / 255.0
         return frame